@@ -5,6 +5,9 @@
 #sys.path.insert(0, os.path.expanduser('~/.local/lib/python3.8/site-packages'))
 import os
 import glob
+import itertools
+import concurrent.futures
+import multiprocessing
 
 #load required pacakges (as always)
 import numpy as np
@@ -12,6 +15,7 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import scipy.stats
 import json
+import logging
 
 #packages for functions imported from hplc.py
 import scipy.signal
@@ -20,6 +24,39 @@ import scipy.special
 import tqdm
 import seaborn as sns
 import matplotlib
+import matplotlib.collections
+
+logger = logging.getLogger(__name__)
+
+# colors of the chromatograms in the overview panel and of the fitted peaks
+_COLORLIST = ('#0072B2', '#E69F00', '#56B4E9', '#009E73', '#F0E442', '#000000', '#D55E00', '#CC79A7', '#999999', '#B2DF8A',
+              '#2C92DF', '#9E0032', '#92D050', '#6D9F00', '#808080', '#E7D4E8', '#7CB8DD', '#F4A460', '#FFEFD5', '#D2691E',
+              '#7FDBFF', '#D68E23', '#B3E2CD', '#68228B', '#E1BEE7', '#90EE90', '#F5F5F5', '#FFFFFF', '#9468E0', '#1EFB90')
+_PEAK_COLORS = ('#a6cee3', '#1f78b4', '#b2df8a', '#33a02c', '#fb9a99', '#e31a1c', '#fdbf6f', '#ff7f00',
+                '#cab2d6', '#6a3d9a')
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, backgroundsubstraction falls back to NumPy
+    njit = None
+
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _snip_pass(t, out, il):
+        """
+        Single Morhac iteration: out[i] = min(t[i], (t[i + il] + t[i - il]) / 2),
+        with the `il` points on either edge copied over unchanged.
+        """
+        n = t.shape[0]
+        for i in range(n):
+            if i < il or i >= n - il:
+                out[i] = t[i]
+            else:
+                a = 0.5 * (t[i + il] + t[i - il])
+                out[i] = t[i] if t[i] < a else a
+else:
+    _snip_pass = None
 
 #Functions and object class imported from cremerlab hplc.py#######################################
 class Chromatogram(object):
@@ -71,27 +108,36 @@ class Chromatogram(object):
         self.time_col = cols['time']
         self.int_col = cols['intensity']
 
-        # Load the chromatogram and necessary components to self.
+        # Load the chromatogram and necessary components to self. Only the time
+        # and intensity columns are kept, parsed straight to float32.
         if type(file) is str:
-            dataframe = pd.read_csv(file, comment='#')
+            dataframe = pd.read_csv(file, comment=csv_comment, usecols=[self.time_col, self.int_col],
+                                    dtype={self.time_col: np.float32, self.int_col: np.float32})
         else:
             dataframe = file
-        self.df = dataframe
+
+        # The chromatogram is stored as plain arrays; `df` is rebuilt from them
+        # on request.
+        self.time_arr = dataframe[self.time_col].to_numpy(dtype=np.float32, copy=True)
+        self.int_arr = dataframe[self.int_col].to_numpy(dtype=np.float32, copy=True)
+        self.int_nobackground_arr = None
+        self.background_arr = None
+        self._df = None
+
+        # Peak windows and crops are positional along the time axis, so make
+        # sure it is ascending. Exported chromatograms already are.
+        if np.any(self.time_arr[1:] < self.time_arr[:-1]):
+            order = np.argsort(self.time_arr, kind='stable')
+            self.time_arr = self.time_arr[order]
+            self.int_arr = self.int_arr[order]
 
         # Prune to time window
         if time_window is not None:
             self.crop(time_window)
-        else:
-            self.df = dataframe
 
         # Correct for a negative baseline
-        df = self.df
-        first_int = df[self.int_col].iloc[0]
         if baselinecorrection:
-            intensity = df[self.int_col] - first_int
-
-            for intns in range(0,len(intensity)):
-                 df.iloc[intns, 2] = intensity[intns]
+            self.int_arr = self.int_arr - self.int_arr[0]
 
         # Blank out vars that are used elsewhere
         self.window_df = None
@@ -99,6 +145,20 @@ class Chromatogram(object):
         self.peaks = None
         self.peak_df = None
 
+    @property
+    def df(self):
+        """
+        The chromatogram as a pandas DataFrame. It is built from the time and
+        intensity arrays on first access and cached until they change.
+        """
+        if self._df is None:
+            columns = {self.time_col: self.time_arr, self.int_col: self.int_arr}
+            if self.background_arr is not None:
+                columns[self.int_col + '_nobackgroundcorrection'] = self.int_nobackground_arr
+                columns[self.int_col + '_background'] = self.background_arr
+            self._df = pd.DataFrame(columns)
+        return self._df
+
     def crop(self, time_window=None, return_df=False):
         """
         Restricts the time dimension of the DataFrame
@@ -119,8 +179,15 @@ class Chromatogram(object):
         if len(time_window) != 2:
             raise ValueError(
                 f'`time_window` must be of length 2 (corresponding to start and end points). Provided list is of length {len(time_window)}.')
-        self.df = self.df[(self.df[self.time_col] >= time_window[0]) &
-                          (self.df[self.time_col] <= time_window[1])]
+        # The time axis is sorted, so the window bounds are a binary search away
+        lo = np.searchsorted(self.time_arr, time_window[0], side='left')
+        hi = np.searchsorted(self.time_arr, time_window[1], side='right')
+        self.time_arr = self.time_arr[lo:hi]
+        self.int_arr = self.int_arr[lo:hi]
+        if self.background_arr is not None:
+            self.int_nobackground_arr = self.int_nobackground_arr[lo:hi]
+            self.background_arr = self.background_arr[lo:hi]
+        self._df = None
         if return_df:
             return self.df
 
@@ -139,28 +206,42 @@ class Chromatogram(object):
         corrected_df : pandas DataFrame
             If `return_df = True`, then the original and the corrected chromatogram are returned.
         """
-        df = self.df
-        try:
-            intensity = self.df[self.int_col + "_nobackgroundcorrection"].values
-        except:
-            intensity = self.df[self.int_col].values
+        if self.int_nobackground_arr is not None:
+            intensity = self.int_nobackground_arr
+        else:
+            intensity = self.int_arr
 
-        intensity_old = intensity.copy()
+        intensity_old = intensity
         intensity = intensity * np.heaviside(intensity, 0)
-        # transform to log scale
-        intensity_transf = np.log(np.log(np.sqrt(intensity + 1) + 1) + 1)
+        # transform to log scale; the passes stay in float32 like the stored
+        # chromatogram, which halves the memory traffic of every iteration
+        intensity_transf = np.ascontiguousarray(np.log(np.log(np.sqrt(intensity + 1) + 1) + 1),
+                                                dtype=np.float32)
         # start itteration
-        for il in range(0, num_iterations):
-            intensity_transf_new = intensity_transf.copy()
-            for i in range(il, intensity_transf.shape[0] - il):
-                intensity_transf_new[i] = min(intensity_transf[i],
-                                              0.5 * (intensity_transf[i + il] + intensity_transf[i - il]))
-            intensity_transf = intensity_transf_new
+        if _snip_pass is not None:
+            # compiled passes, ping-ponging between two buffers
+            buf = np.empty_like(intensity_transf)
+            for il in range(0, num_iterations):
+                _snip_pass(intensity_transf, buf, il)
+                intensity_transf, buf = buf, intensity_transf
+        else:
+            # reuse one scratch buffer for the neighbour means
+            n_points = intensity_transf.shape[0]
+            scratch = np.empty_like(intensity_transf)
+            for il in range(0, num_iterations):
+                n_inner = n_points - 2 * il
+                if n_inner <= 0:
+                    break
+                mean = scratch[:n_inner]
+                np.add(intensity_transf[2 * il:], intensity_transf[:n_inner], out=mean)
+                mean *= 0.5
+                np.minimum(intensity_transf[il:n_points - il], mean, out=intensity_transf[il:n_points - il])
         # transform back
         intensity = np.power(np.exp(np.exp(intensity_transf) - 1.) - 1., 2.) - 1.
-        self.df[self.int_col] = intensity_old - intensity
-        self.df[self.int_col + '_nobackgroundcorrection'] = intensity_old
-        self.df[self.int_col + '_background'] = intensity
+        self.int_arr = intensity_old - intensity
+        self.int_nobackground_arr = intensity_old
+        self.background_arr = intensity
+        self._df = None
 
         if return_df:
             return self.df
@@ -187,10 +268,10 @@ class Chromatogram(object):
         -------
         windows : pandas DataFrame
             A Pandas DataFrame with each measurement assigned to an identified
-            peak or overlapping peak set. This returns a copy of the chromatogram
-            DataFrame with  a column  for the local baseline and one column for
-            the window IDs. Window ID of -1 corresponds to area not assigned to
-            any peaks
+            peak or overlapping peak set. This returns the time and intensity
+            of every point assigned to a window, with a column for the local
+            baseline and one column for the window IDs. Points not assigned to
+            any peaks are left out.
         """
         for param, param_name, param_type in zip([prominence, rel_height, buffer],
                                                  ['prominence', 'rel_height', 'buffer'],
@@ -206,15 +287,14 @@ class Chromatogram(object):
             raise ValueError('Parameter `buffer` cannot be less than 0.')
 
         # Correct for a negative baseline
-        df = self.df
-        intensity = self.df[self.int_col].values
+        intensity = self.int_arr
         norm_int = (intensity - intensity.min()) / (intensity.max() - intensity.min())
 
         # Identify the peaks and get the widths and baselines
         if manual_peak_positions == None:
             peaks, _ = scipy.signal.find_peaks(norm_int, prominence=prominence)
         else:
-            timew = self.df[self.time_col].values
+            timew = self.time_arr
             deltatw = (timew[-1] - timew[0]) / np.float64(timew.shape[0])
             peaks = np.int_((np.array(manual_peak_positions) - timew[
                 0]) / deltatw)  # peeak position in descrete step of time-window
@@ -227,76 +307,89 @@ class Chromatogram(object):
         self.peaks_inds = peaks
 
         # need to fix, not needed for manual peak position
+        # Both width evaluations share the same prominences, so compute them once
+        prominence_data = scipy.signal.peak_prominences(intensity, peaks)
         out = scipy.signal.peak_widths(intensity, peaks,
-                                       rel_height=rel_height)
+                                       rel_height=rel_height, prominence_data=prominence_data)
         _, heights, left, right = out
         widths, _, _, _ = scipy.signal.peak_widths(intensity, peaks,
-                                                   rel_height=0.5)
+                                                   rel_height=0.5, prominence_data=prominence_data)
 
         ###
-        # Set up the ranges
-        ranges = []
-        for l, r in zip(left, right):
-            if (l - buffer) < 0:
-                l = 0
-            else:
-                l -= buffer
-            if (r + buffer) > len(norm_int):
-                r = len(norm_int)
+        # Set up the ranges as [start, end) index bounds
+        starts = np.round(np.maximum(left - buffer, 0)).astype(int)
+        ends = np.round(np.minimum(right + buffer, len(norm_int))).astype(int)
+
+        # Identiy subset ranges and remove. Sweeping by start (widest first on
+        # ties), a range lies inside an earlier one iff it ends before the furthest
+        # end seen so far.
+        valid = np.ones(len(starts), dtype=bool)
+        furthest_end = -1
+        for j in np.lexsort((-ends, starts)):
+            if ends[j] <= furthest_end:
+                valid[j] = False
             else:
-                r += buffer
-            ranges.append(np.arange(np.round(l), np.round(r), 1))
-
-        # Identiy subset ranges and remove
-        valid = [True] * len(ranges)
-        for i, r1 in enumerate(ranges):
-            for j, r2 in enumerate(ranges):
-                if i != j:
-                    if set(r2).issubset(r1):
-                        valid[j] = False
+                furthest_end = ends[j]
 
         # Keep only valid ranges and baselines
-        ranges = [r for i, r in enumerate(ranges) if valid[i] is True]
-        baselines = [h for i, h in enumerate(heights) if valid[i] is True]
-
-        # Copy the dataframe and return the windows
-
-        window_df = df.copy(deep=True)
-        window_df.sort_values(by=self.time_col, inplace=True)
-        window_df['time_idx'] = np.arange(len(window_df))
-        for i, r in enumerate(ranges):
-            window_df.loc[window_df['time_idx'].isin(r),
-            'window_idx'] = int(i + 1)
-            window_df.loc[window_df['time_idx'].isin(r),
-            'baseline'] = baselines[i]
-        window_df.dropna(inplace=True)
+        bounds = list(zip(starts[valid], ends[valid]))
+        baselines = heights[valid]
+
+        # Label the windows. The time axis is sorted on load, so positions are
+        # time indices and each window is a plain slice of the label arrays.
+        int_arr = self.int_arr
+        time_arr = self.time_arr
+        window_idx = np.full(len(time_arr), np.nan)
+        window_baseline = np.full(len(time_arr), np.nan)
+        for i, (l, r) in enumerate(bounds):
+            window_idx[l:r] = i + 1
+            window_baseline[l:r] = baselines[i]
+
+        # Only the points assigned to a window make it into the returned frame
+        time_idx = np.flatnonzero(~np.isnan(window_idx))
+        window_df = pd.DataFrame({self.time_col: time_arr[time_idx],
+                                  self.int_col: int_arr[time_idx],
+                                  'time_idx': time_idx,
+                                  'window_idx': window_idx[time_idx],
+                                  'baseline': window_baseline[time_idx]},
+                                 index=time_idx)
 
         # Convert this to a dictionary for easy parsing
         window_dict = {}
 
-        time_step = np.mean(np.diff(self.df[self.time_col].values))
-        for g, d in window_df.groupby('window_idx'):
-            _peaks = [p for p in peaks if (p in d['time_idx'].values) and (d[d['time_idx'] == p][self.int_col].values[
-                                                                               0] > 0)]  # ignores peaks where intensity is smaller zero
-            peak_inds = [x for _p in _peaks for x in np.where(peaks == _p)[0]]
+        # mean sampling interval; the sum of the differences telescopes to the endpoints
+        time_step = (time_arr[-1] - time_arr[0]) / (time_arr.shape[0] - 1)
+
+        # Nested ranges are gone, so a later window can only overwrite the ends
+        # of an earlier one and every window is a single run of equal labels.
+        # Walk these runs in window order instead of grouping the frame.
+        labels = window_idx[time_idx]
+        run_starts = np.flatnonzero(np.diff(labels, prepend=np.nan) != 0)
+        run_ends = np.append(run_starts[1:], len(labels))
+        for j in np.argsort(labels[run_starts], kind='stable'):
+            g = labels[run_starts[j]]
+            l, r = time_idx[run_starts[j]], time_idx[run_ends[j] - 1] + 1
+            # ignores peaks where intensity is smaller zero
+            sel = np.flatnonzero((peaks >= l) & (peaks < r) & (int_arr[peaks] > 0))
+            _peaks = peaks[sel]
             if baselinecorrection:
-                _dict = {'time_range': d[self.time_col].values,
-                         'intensity': d[self.int_col] - baselines[i],  # ? is this the good correction to make
-                         'intensity_nobaselinecorrection': d[self.int_col],  # added
+                baseline = baselines[int(g) - 1]
+                _dict = {'time_range': time_arr[l:r],
+                         'intensity': int_arr[l:r] - baseline,  # ? is this the good correction to make
+                         'intensity_nobaselinecorrection': int_arr[l:r],  # added
                          'num_peaks': len(_peaks),
-                         'amplitude': [d[d['time_idx'] == p][self.int_col].values[0] - baselines[i] for p in _peaks],
-                         'amplitude_nobaselinecorrection': [d[d['time_idx'] == p][self.int_col].values[0] for p in
-                                                            _peaks],
-                         'location': [d[d['time_idx'] == p][self.time_col].values[0] for p in _peaks],
-                         'width': [widths[ind] * time_step for ind in peak_inds]
+                         'amplitude': int_arr[_peaks] - baseline,
+                         'amplitude_nobaselinecorrection': int_arr[_peaks],
+                         'location': time_arr[_peaks],
+                         'width': widths[sel] * time_step
                          }
             else:
-                _dict = {'time_range': d[self.time_col].values,
-                         'intensity': d[self.int_col],  # added
+                _dict = {'time_range': time_arr[l:r],
+                         'intensity': int_arr[l:r],  # added
                          'num_peaks': len(_peaks),
-                         'amplitude': [d[d['time_idx'] == p][self.int_col].values[0] for p in _peaks],
-                         'location': [d[d['time_idx'] == p][self.time_col].values[0] for p in _peaks],
-                         'width': [widths[ind] * time_step for ind in peak_inds]
+                         'amplitude': int_arr[_peaks],
+                         'location': time_arr[_peaks],
+                         'width': widths[sel] * time_step
                          }
             window_dict[g] = _dict
         self.window_props = window_dict
@@ -341,9 +434,37 @@ class Chromatogram(object):
         _x = alpha * (x - loc) / scale
         normfactor = 1  # np.sqrt(2 * np.pi * scale**2)**-1 *
         norm = normfactor * np.exp(-(x - loc) ** 2 / (2 * scale ** 2))
-        cdf = (1 + scipy.special.erf(_x / np.sqrt(2)))
+        # 1 + erf(x / sqrt(2)) == 2 * ndtr(x), in a single ufunc call
+        cdf = 2 * scipy.special.ndtr(_x)
         return amp * norm * cdf
 
+    def _integrate_skewnorm(self, lower, upper, *params):
+        R"""
+        Integrates the lineshape of `_compute_skewnorm` between two time points
+        in closed form.
+        Parameters
+        ----------
+        lower, upper : float or numpy array
+            The integration bounds in the time dimension.
+        params : list, [amplitude, loc, scale, alpha]
+            Parameters for the shape and scale parameters of the skewnorm
+            distribution, as for `_compute_skewnorm`.
+        Returns
+        -------
+        area : float or numpy array
+            The area under the peak between `lower` and `upper`.
+        Notes
+        -----
+        With :math:`z = (t - r_t)/\sigma` the peak is
+        :math:`I_\text{max}\sigma\sqrt{2\pi}` times the skew-normal density in
+        :math:`z`, whose CDF is :math:`\Phi(z) - 2T(z, \alpha)` with :math:`T`
+        Owen's T function.
+        """
+        amp, loc, scale, alpha = params
+        z = (np.array([lower, upper], dtype=float) - loc) / scale
+        cdf = scipy.special.ndtr(z) - 2 * scipy.special.owens_t(z, alpha)
+        return amp * scale * np.sqrt(2 * np.pi) * (cdf[1] - cdf[0])
+
     def _fit_skewnorms(self, x, *params):
         R"""
         Estimates the parameters of the distributions which consititute the
@@ -381,7 +502,109 @@ class Chromatogram(object):
             out += self._compute_skewnorm(x, *params[i])
         return out
 
-    def _estimate_peak_params(self, boundpars=None, verbose=True, baselinecorretion=False):
+    def _skewnorm_jac(self, x, *params):
+        R"""
+        Computes the analytical Jacobian of `_fit_skewnorms` with respect to
+        its parameters, for use by the curve fitting.
+        Parameters
+        ----------
+        x : numpy array
+            The time dimension of the skewnorm
+        params : list of length 4 x number of peaks, [amplitude, loc, scale, alpha]
+            Parameters for the shape and scale parameters of the skewnorm
+            distributions, in the same order as for `_fit_skewnorms`.
+        Returns
+        -------
+        jac : numpy array, shape (len(x), len(params))
+            The partial derivatives of the summed distributions with respect
+            to each parameter, evaluated at every time point.
+        Notes
+        -----
+        With :math:`z = (t - r_t)/\sigma`, each peak is
+        :math:`I = I_\text{max} e^{-z^2/2}\left[1 + \text{erf}\frac{\alpha z}{\sqrt{2}}\right]`,
+        and the derivative of the erf term is a Gaussian in :math:`\alpha z`.
+        """
+        x = np.asarray(x, dtype=float)[:, None]
+        amp, loc, scale, alpha = np.reshape(params, (-1, 4)).T
+        z = (x - loc) / scale
+        norm = np.exp(-z ** 2 / 2)
+        cdf = 2 * scipy.special.ndtr(alpha * z)
+        skew = np.sqrt(2 / np.pi) * np.exp(-(alpha * z) ** 2 / 2)
+        d_z = amp * norm * (alpha * skew - z * cdf)
+        jac = np.stack([norm * cdf,
+                        -d_z / scale,
+                        -d_z * z / scale,
+                        amp * norm * skew * z], axis=-1)
+        return jac.reshape(x.shape[0], -1)
+
+    def _fit_one_window(self, k, v, boundpars=None):
+        """
+        Fits the skew-normal distributions of a single peak window. Returns the
+        dictionary of fitted peak parameters, or `None` if the window holds no
+        peak or the fit did not converge.
+        """
+        window_dict = {}
+        # Set up the initial guess, one [amplitude, location, scale, skew] row per peak
+        amps = np.asarray(v['amplitude'])  # before w/ baseline correction
+        locs = np.asarray(v['location'])
+        ones = np.ones(len(amps))
+        p0 = np.stack([amps, locs,
+                       np.maximum(np.asarray(v['width']) / 4., 0.05),  # scale parameter
+                       ones * 0],  # Skew parameter, starts with assuming Gaussian
+                      axis=1).ravel()
+
+        # REMOVE OPTION NOBASELINE..
+        # Set boundaries of fitting
+        if boundpars == None:  # standard values
+            lower = [amps * 0.5,  # min amplitude
+                     ones * v['time_range'].min(),  # min peak position
+                     ones * 0,  # min width
+                     ones * -np.inf]  # min skew parameter
+            upper = [amps * 2 + 2,  # max amplitude #?before with baselinecorrection
+                     ones * v['time_range'].max(),  # max peak position
+                     ones * np.inf,  # max width
+                     ones * np.inf]  # skew parameter
+        else:
+            lower = [amps * boundpars[0], locs - boundpars[1], ones * boundpars[2], ones * boundpars[3]]
+            upper = [amps * boundpars[4] + 2, locs + boundpars[5], ones * boundpars[6], ones * boundpars[7]]
+        bounds = (np.stack(lower, axis=1).ravel(), np.stack(upper, axis=1).ravel())
+
+        # Perform the inference
+        if len(p0) > 0:
+            try:
+                logger.debug('window %s: p0 %s, bounds %s', k, p0, bounds)
+                popt, _ = scipy.optimize.curve_fit(self._fit_skewnorms, v['time_range'],
+                                                   v['intensity'], p0=p0, bounds=bounds,
+                                                   jac=self._skewnorm_jac, method='trf',
+                                                   maxfev=int(1E6))
+                # Assemble the dictionary of output
+                if v['num_peaks'] > 1:
+                    popt = np.reshape(popt, (v['num_peaks'], 4))
+                else:
+                    popt = [popt]
+                for i, p in enumerate(popt):
+                    window_dict[f'peak_{i + 1}'] = {
+                        'retention_time_firstguess': v['location'][i],
+                        'amplitude': p[0],
+                        'retention_time': p[1],
+                        'std_dev': p[2],
+                        'alpha': p[3],
+                        'area': self._integrate_skewnorm(v['time_range'][0], v['time_range'][-1], *p)}
+
+                return window_dict
+            except RuntimeError:
+                print(
+                    'Warning: Parameters could not be inferred for one peak')  # ? or there is no peak in that window
+                print(p0)
+                print(v['time_range'].max())
+                print(v['time_range'].min())
+                print(v['intensity'])
+        else:
+            pass
+            # print("Warning: Window without any peak to search for")
+        return None
+
+    def _estimate_peak_params(self, boundpars=None, verbose=True, baselinecorretion=False, n_threads=None):
         R"""
         For each peak window, estimate the parameters of skew-normal distributions
         which makeup the peak(s) in the window.
@@ -402,103 +625,42 @@ class Chromatogram(object):
 
         verbose : bool
             If `True`, a progress bar will be printed during the inference.
+        n_threads : int or None
+            Number of threads used to fit the peak windows. Default is `None`,
+            meaning one thread per CPU (`os.cpu_count()`); 1 fits the windows serially.
         """
         if self.window_props is None:
             raise RuntimeError('Function `_assign_peak_windows` must be run first. Go do that.')
-        if verbose:
-            iterator = tqdm.tqdm(self.window_props.items(), desc='Fitting peak windows...')
+
+        # Windows are fitted independently; curve_fit spends most of its time
+        # in LAPACK, which releases the GIL, so threads are enough here
+        keys = list(self.window_props.keys())
+        fit_args = (keys, self.window_props.values(), itertools.repeat(boundpars))
+        if n_threads is None:
+            n_threads = os.cpu_count() or 1
+        n_threads = min(n_threads, len(keys))
+        if n_threads <= 1:
+            executor = None
+            results = map(self._fit_one_window, *fit_args)
         else:
-            iterator = self.window_props.items()
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_threads)
+            results = executor.map(self._fit_one_window, *fit_args)
+        if verbose:
+            results = tqdm.tqdm(results, total=len(keys), desc='Fitting peak windows...')
         peak_props = {}
-        for k, v in iterator:
-            window_dict = {}
-            # Set up the initial guess
-            p0 = []
-            bounds = [[], []]
-            for i in range(v['num_peaks']):
-
-                # if v['amplitude'][i]<0: #ignore peaks with negative amplitude
-                #    print("peak "+str(i)+"amplitude: "+str(v['amplitude'][i])+" at position: "+str(v['location'][i]))
-                #    print("Warning: negative amplitude. Value before reset: "+str(v['amplitude'][i])+" at time "+str(v['location'][i]))
-                #    v['amplitude'][i]=0
-                # if v['amplitude_nobaselinecorrection'][i]<0: #ignore peaks with negative amplitude
-                #    print("peak "+str(i)+"amplitude: "+str(v['amplitude'][i])+" at position: "+str(v['location'][i]))
-                #    print("Warning: negative amplitude. Value before reset: "+str(v['amplitude_nobaselinecorrection'][i])+" at time "+str(v['location'][i]))
-                #    v['amplitude_nobaselinecorrection'][i]=0
-                p0.append(v['amplitude'][i])  # before w/ baseline correction
-
-                p0.append(v['location'][i]),
-                p0.append(max(v['width'][i] / 4., 0.05))  # scale parameter
-                p0.append(0)  # Skew parameter, starts with assuming Gaussian
-
-                # REMOVE OPTION NOBASELINE..
-                # Set boundaries of fitting
-                if boundpars == None:  # standard values
-                    # lower boundaries
-                    bounds[0].append(v['amplitude'][i] * 0.5)  # min amplitude
-                    bounds[0].append(v['time_range'].min())  # min peak position
-                    bounds[0].append(0)  # min width
-                    bounds[0].append(-np.inf)  # min skew parameter
-                    # upper boundaries
-                    bounds[1].append(v['amplitude'][i] * 2 + 2)  # max amplitude #?before with baselinecorrection
-                    bounds[1].append(v['time_range'].max())  # max peak position
-                    bounds[1].append(np.inf)  # max width
-                    bounds[1].append(np.inf)  # skew parameter
-                else:
-                    # lower boundaries
-                    bounds[0].append(v['amplitude'][i] * boundpars[0])
-                    bounds[0].append(v['location'][i] - boundpars[1])
-                    bounds[0].append(boundpars[2])
-                    bounds[0].append(boundpars[3])
-                    # upper boundaries
-                    bounds[1].append(v['amplitude'][i] * boundpars[4] + 2)
-                    bounds[1].append(v['location'][i] + boundpars[5])
-                    bounds[1].append(boundpars[6])
-                    bounds[1].append(boundpars[7])
-
-                    # Perform the inference
-            if len(p0) > 0:
-                try:
-                    print("p0")
-                    print(p0)
-                    print("bounds")
-                    print(bounds)
-                    print(np.array(p0) - np.array(bounds[0]))
-                    print(np.array(bounds[1]) - np.array(p0))
-                    popt, _ = scipy.optimize.curve_fit(self._fit_skewnorms, v['time_range'],
-                                                       v['intensity'], p0=p0, bounds=bounds,
-                                                       maxfev=int(1E6))
-                    # Assemble the dictionary of output
-                    if v['num_peaks'] > 1:
-                        popt = np.reshape(popt, (v['num_peaks'], 4))
-                    else:
-                        popt = [popt]
-                    for i, p in enumerate(popt):
-                        window_dict[f'peak_{i + 1}'] = {
-                            'retention_time_firstguess': v['location'][i],
-                            'amplitude': p[0],
-                            'retention_time': p[1],
-                            'std_dev': p[2],
-                            'alpha': p[3],
-                            'area': self._compute_skewnorm(v['time_range'], *p).sum() * float(
-                                v['time_range'][-1] - [v['time_range'][0]]) / float(v['time_range'].shape[0] - 1)}
-
+        try:
+            for k, window_dict in zip(keys, results):
+                if window_dict is not None:
                     peak_props[k] = window_dict
-                except RuntimeError:
-                    print(
-                        'Warning: Parameters could not be inferred for one peak')  # ? or there is no peak in that window
-                    print(p0)
-                    print(v['time_range'].max())
-                    print(v['time_range'].min())
-                    print(v['intensity'])
-            else:
-                pass
-                # print("Warning: Window without any peak to search for")
+        finally:
+            if executor is not None:
+                executor.shutdown()
         self.peak_props = peak_props
         return peak_props
 
     def quantify(self, time_window=None, prominence=1E-3, rel_height=1.0,
-                 buffer=100, manual_peak_positions=None, boundpars=None, peakpositionsonly=False, verbose=True):
+                 buffer=100, manual_peak_positions=None, boundpars=None, peakpositionsonly=False, verbose=True,
+                 n_threads=None):
         R"""
         Quantifies peaks present in the chromatogram
         Parameters
@@ -522,6 +684,9 @@ class Chromatogram(object):
             If ture, only the peak positions will be provided and no full analys of peaks is included
         verbose : bool
             If True, a progress bar will be printed during the inference.
+        n_threads : int or None
+            Number of threads used to fit the peak windows. Default is `None`,
+            one thread per CPU; 1 fits the windows serially.
         Returns
         -------
         peak_df : pandas DataFrame
@@ -539,9 +704,7 @@ class Chromatogram(object):
         """
 
         if time_window is not None:
-            dataframe = self.df
-            self.df = dataframe[(dataframe[self.time_col] >= time_window[0]) &
-                                (dataframe[self.time_col] <= time_window[1])].copy(deep=True)
+            self.crop(time_window)
 
             # Assign the window bounds (contains peak autodetection)
         _ = self._assign_peak_windows(prominence, rel_height, buffer, manual_peak_positions=manual_peak_positions)
@@ -559,10 +722,10 @@ class Chromatogram(object):
             return peakpositions
 
         # Infer the distributions for the peaks
-        peak_props = self._estimate_peak_params(boundpars=boundpars, verbose=verbose)
+        peak_props = self._estimate_peak_params(boundpars=boundpars, verbose=verbose, n_threads=n_threads)
 
         # Set up a dataframe of the peak properties
-        peak_df = pd.DataFrame([])
+        rows = []
         iter = 0
         for _, peaks in peak_props.items():
             for _, params in peaks.items():
@@ -574,27 +737,17 @@ class Chromatogram(object):
                          'area': params['area'],
                          'peak_idx': iter + 1}
                 iter += 1
-                print("type of peak_df:", type(peak_df))
-                print("content of peak_df", peak_df)
-                peak_df = pd.concat([peak_df, pd.DataFrame([_dict])], ignore_index=True)
-                peak_df['peak_idx'] = peak_df['peak_idx'].astype(int)
+                rows.append(_dict)
+        peak_df = pd.DataFrame(rows, columns=['retention_time', 'retention_time_firstguess', 'scale', 'skew',
+                                              'amplitude', 'area', 'peak_idx'])
+        peak_df['peak_idx'] = peak_df['peak_idx'].astype(int)
         self.peak_df = peak_df
 
-        # Compute the mixture
-        time = self.df[self.time_col].values
-        out = np.zeros((len(time), len(peak_df)))
-        iter = 0
-        for _k, _v in self.peak_props.items():
-            for k, v in _v.items():
-                params = [v['amplitude'], v['retention_time'],
-                          v['std_dev'], v['alpha']]
-                # print(params)
-                # print(time)
-                # print(self._compute_skewnorm(time, *params))
-
-                out[:, iter] = self._compute_skewnorm(time, *params)
-                iter += 1
-        self.mix_array = out
+        # Compute the mixture, broadcasting the time axis against the
+        # parameters of all peaks so every peak is evaluated in one pass
+        time = self.time_arr
+        params = peak_df[['amplitude', 'retention_time', 'scale', 'skew']].to_numpy(dtype=float).T
+        self.mix_array = self._compute_skewnorm(time[:, None], *params)
         return peak_df
 
     def show(self):
@@ -609,12 +762,12 @@ class Chromatogram(object):
         ax.set_ylabel(self.int_col)
 
         # Plot the raw chromatogram
-        ax.plot(self.df[self.time_col], self.df[self.int_col], 'k-', lw=2,
+        ax.plot(self.time_arr, self.int_arr, 'k-', lw=2,
                 label='raw chromatogram')
 
         # Compute the skewnorm mix
         if self.peak_df is not None:
-            time = self.df[self.time_col].values
+            time = self.time_arr
             # Plot the mix
             convolved = np.sum(self.mix_array, axis=1)
             ax.plot(time, convolved, 'r--', label='inferred mixture')
@@ -626,11 +779,27 @@ class Chromatogram(object):
         return [fig, ax]
 
 
+def _process_file(f, cols, time_window, backgroundsubstraction,
+                  backgroundsubstraction_iterations, manual_peak_positions, kwargs):
+    """
+    Parses and quantifies a single chromatogram for `batch_process`. Defined
+    at module level so it can be pickled and sent to worker processes.
+    Returns the chromatogram DataFrame, the peak table and the mixture array.
+    """
+    chrom = Chromatogram(f, cols=cols, time_window=time_window)
+
+    if backgroundsubstraction:
+        chrom.backgroundsubstraction(num_iterations=backgroundsubstraction_iterations)
+
+    peaks = chrom.quantify(verbose=False, manual_peak_positions=manual_peak_positions, **kwargs)
+    return chrom.df, peaks, chrom.mix_array
+
+
 def batch_process(file_paths, time_window=None,  show_viz=False,
                   cols={'time' :'time_min', 'intensity' :'intensity_mV'},
                   lower_limit=None, upper_limit=None,plot_comp = False, manual_peak_positions=None ,backgroundsubstraction=True
                   ,backgroundsubstraction_iterations=80 , plot_characteristictimes=False ,plot_output=False,plot_show = False,
-                  **kwargs):
+                  n_jobs=1, **kwargs):
     """
     Performs complete quantification of a set of HPLC data. Data must first
     be converted to a tidy long-form CSV file by using `cremerlab.hplc.convert`
@@ -660,6 +829,12 @@ def batch_process(file_paths, time_window=None,  show_viz=False,
     backgroundsubstraction_iterations : int
         Number of neighboring time-points to use for background substraction
     plot_characteristictimes : [list_name_charact, list_time_range_characteristics]
+    n_jobs : int or None
+        Number of worker processes used to parse and quantify the files.
+        Default is 1 (serial), `None` uses one process per CPU (`os.cpu_count()`).
+        Workers are spawned, not forked. With more than one process the peak
+        windows of each file are fitted on one thread, unless `n_threads` is
+        passed in kwargs.
     kwargs: dict, **kwargs
         **kwargs for the peak quantification function `cremerlab.hplc.Chromatogram.quantify`
     Returns
@@ -675,45 +850,69 @@ def batch_process(file_paths, time_window=None,  show_viz=False,
     """
 
     # Instantiate storage lists
-    chrom_dfs, peak_dfs, mixes = [], [], []
+    chrom_dfs, peak_dfs, mixes, sample_names = [], [], [], []
+
+    # Resolve the manual peak positions for each file
+    if manual_peak_positions == None or type(manual_peak_positions[0]) != list:
+        file_peak_positions = [manual_peak_positions] * len(file_paths)
+    else:
+        file_peak_positions = manual_peak_positions
+
+    # Files are independent, so they can be quantified in worker processes.
+    # The processes already occupy the cores, so each fits its windows serially.
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(n_jobs, len(file_paths))
+    if n_jobs > 1:
+        kwargs.setdefault('n_threads', 1)
+    process_args = (file_paths, itertools.repeat(cols), itertools.repeat(time_window),
+                    itertools.repeat(backgroundsubstraction),
+                    itertools.repeat(backgroundsubstraction_iterations),
+                    file_peak_positions, itertools.repeat(kwargs))
+
+    # Results come back in the order of `file_paths`. Workers are spawned, not forked,
+    # so they never inherit the state of the numba kernels loaded in this process
+    if n_jobs <= 1:
+        executor = None
+        results = map(_process_file, *process_args)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs,
+                                                          mp_context=multiprocessing.get_context('spawn'))
+        results = executor.map(_process_file, *process_args)
 
     # Perform the processing for each file
-    for i, f in enumerate(tqdm.tqdm(file_paths, desc='Processing files...')):
-        # Generate the sample id
-        if '/' in f:
-            file_name = f.split('/')[-1]
-        else:
-            file_name = f
-
-        # Check for common file name extension
-        for pat in ['.csv', '.txt']:
-            if pat in file_name:
-                file_name = file_name.split(pat)[0]
-                continue
-
-        # Parse the chromatogram and quantify the peaks
-        chrom = Chromatogram(f, cols=cols, time_window=time_window)
-
-        if backgroundsubstraction:
-            chrom.backgroundsubstraction(num_iterations=backgroundsubstraction_iterations)
-
-        if manual_peak_positions == None or type(manual_peak_positions[0]) != list:
-            peaks = chrom.quantify(verbose=False, manual_peak_positions=manual_peak_positions, **kwargs)
-        else:
-            peaks = chrom.quantify(verbose=False, manual_peak_positions=manual_peak_positions[i], **kwargs)
-        # Set up the dataframes for chromatograms and peaks
-        _df = chrom.df
-        _df['sample'] = file_name
-        peaks['sample'] = file_name
-        peak_dfs.append(peaks)
-
-        print(peaks)                         ## display specific to IPython
-        chrom_dfs.append(chrom.df)
-        mixes.append(chrom.mix_array)
-
-    # Concatenate the dataframe
-    chrom_df = pd.concat(chrom_dfs, sort=False)
-    peak_df = pd.concat(peak_dfs, sort=False)
+    try:
+        for f, (_df, peaks, mix_array) in tqdm.tqdm(zip(file_paths, results), total=len(file_paths),
+                                                  desc='Processing files...'):
+            # Generate the sample id
+            if '/' in f:
+                file_name = f.split('/')[-1]
+            else:
+                file_name = f
+
+            # Check for common file name extension
+            for pat in ['.csv', '.txt']:
+                if pat in file_name:
+                    file_name = file_name.split(pat)[0]
+                    continue
+
+            # Set up the dataframes for chromatograms and peaks
+            peaks['sample'] = file_name
+            peak_dfs.append(peaks)
+
+            print(peaks)                         ## display specific to IPython
+            chrom_dfs.append(_df)
+            sample_names.append(file_name)
+            mixes.append(mix_array)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # Concatenate the dataframes once. The chromatogram sample id is added
+    # afterwards as a categorical column instead of one string per time point.
+    chrom_df = pd.concat(chrom_dfs, sort=False, ignore_index=True)
+    chrom_df['sample'] = pd.Categorical(np.repeat(sample_names, [len(d) for d in chrom_dfs]))
+    peak_df = pd.concat(peak_dfs, sort=False, ignore_index=True)
 
     # Determine the size of the figure
     num_traces = len(chrom_df['sample'].unique())+1
@@ -721,15 +920,12 @@ def batch_process(file_paths, time_window=None,  show_viz=False,
     num_rows = int(np.ceil(num_traces / num_cols))
     unused_axes = (num_cols * num_rows) - num_traces
 
-    # Instantiate the figure
-    fig, ax = plt.subplots(num_rows, num_cols, figsize=(12 * num_cols, 8 * num_rows))
+    # Instantiate the figure, with the tick and axis label sizes set once for all axes
+    with plt.rc_context({'xtick.labelsize': 15, 'ytick.labelsize': 15, 'axes.labelsize': 20}):
+        fig, ax = plt.subplots(num_rows, num_cols, figsize=(12 * num_cols, 8 * num_rows))
 
     ax = ax.ravel()
-    for a in ax:
-        a.xaxis.set_tick_params(labelsize=15)
-        a.yaxis.set_tick_params(labelsize=15)
-        a.set_ylabel(cols['intensity'], fontsize=20)
-        a.set_xlabel(cols['time'], fontsize=20)
+    plt.setp(ax, xlabel=cols['time'], ylabel=cols['intensity'])
     for i in range(unused_axes):
         ax[-(i + 1)].axis('off')
 
@@ -737,15 +933,11 @@ def batch_process(file_paths, time_window=None,  show_viz=False,
     mapper = {g: i for i, g in enumerate(chrom_df['sample'].unique())}
     mapper['all_chromatograms'] = num_traces - 1
 
-    colorlist =['#0072B2', '#E69F00', '#56B4E9', '#009E73', '#F0E442', '#000000', '#D55E00', '#CC79A7', '#999999', '#B2DF8A',
-                '#2C92DF', '#9E0032', '#92D050', '#6D9F00', '#808080', '#E7D4E8', '#7CB8DD', '#F4A460', '#FFEFD5', '#D2691E',
-                '#7FDBFF', '#D68E23', '#B3E2CD', '#68228B', '#E1BEE7', '#90EE90', '#F5F5F5', '#FFFFFF', '#9468E0', '#1EFB90',
-                '#0072B2', '#E69F00', '#56B4E9', '#009E73', '#F0E442', '#000000', '#D55E00', '#CC79A7', '#999999', '#B2DF8A',
-                '#2C92DF', '#9E0032', '#92D050', '#6D9F00', '#808080', '#E7D4E8', '#7CB8DD', '#F4A460', '#FFEFD5', '#D2691E',]
-    col_idx = 0
+    chrom_colors = itertools.cycle(_COLORLIST)
 
     # Plot the chromatogram
-    for g, d in chrom_df.groupby('sample'):
+    for g, d in chrom_df.groupby('sample', observed=True):
+        colorg = next(chrom_colors)
         if backgroundsubstraction:
             ax[mapper[g]].plot(d[cols['time']], d[cols['intensity']], 'b-', lw=1.5,
                                label='after BG correct.')
@@ -754,41 +946,35 @@ def batch_process(file_paths, time_window=None,  show_viz=False,
             ax[mapper[g]].plot(d[cols['time']], d[cols['intensity' ] +"_background"], color='m' ,ls=':', lw=1.5,
                                label='background')
             ax[mapper['all_chromatograms']].plot(d[cols['time']], d[cols['intensity'] + '_nobackgroundcorrection'],
-                                                 color=colorlist[col_idx], lw=1.5,
+                                                 color=colorg, lw=1.5,
                                                  label=g)
         else:
             ax[mapper[g]].plot(d[cols['time']], d[cols['intensity']], 'b-', lw=1.5,
                                label='original')
-            ax[mapper['all_chromatograms']].plot(d[cols['time']], d[cols['intensity']], color=colorlist[col_idx],
+            ax[mapper['all_chromatograms']].plot(d[cols['time']], d[cols['intensity']], color=colorg,
                                                  lw=1.5,
                                                  label=g)
         ax[mapper[g]].set_title(' '.join(g.split('_')), fontsize=12)
-        col_idx = col_idx + 1
 
     # Plot the mapped peaks
-    curgroupby =peak_df.groupby(['sample'])
-    for g, d in peak_df.groupby(['sample']):
+    for g, d in peak_df.groupby('sample'):
         mix = mixes[mapper[g]]
         # display(g)
         # display(d)
         # display(mix)
 
         convolved = np.sum(mix, axis=1)
-        for i in range(len(d)):
-            _m = np.array(mix[:, i])
-            colorlist = ['#a6cee3', '#1f78b4', '#b2df8a', '#33a02c', '#fb9a99', '#e31a1c', '#fdbf6f', '#ff7f00',
-                         '#cab2d6', '#6a3d9a']
-            colorc = colorlist[i % 10]
-            time = np.linspace(time_window[0], time_window[1], len(_m))
-            ax[mapper[g]].fill_between(time, 0, _m, alpha=0.5, label=f'peak {i + 1}', color=colorc)
-            try:
-                ax[mapper[g]].axvline(d.at[i, 'retention_time'], ls='--', alpha=1,
-                                      color=colorc)  # print retention time of fit
-                # ax[mapper[g]].axhline(d.at[i,'amplitude'],ls=':',alpha=0.5,color=colorc) #print retention time of first peak est.
-
-            except:
-                pass
-        time = np.linspace(time_window[0], time_window[1], len(convolved))
+        time = np.linspace(time_window[0], time_window[1], mix.shape[0])
+
+        # fill all peaks of the sample as one collection of closed polygons
+        peak_colors = [c for c, _ in zip(itertools.cycle(_PEAK_COLORS), range(len(d)))]
+        verts = [np.concatenate([np.column_stack([time, mix[:, i]]), [[time[-1], 0], [time[0], 0]]])
+                 for i in range(len(d))]
+        ax[mapper[g]].add_collection(matplotlib.collections.PolyCollection(
+            verts, facecolors=peak_colors, edgecolors=peak_colors, alpha=0.5, label='fitted peaks'))
+        # print retention time of fit
+        ax[mapper[g]].vlines(d['retention_time'].to_numpy(), 0, 1, transform=ax[mapper[g]].get_xaxis_transform(),
+                             colors=peak_colors, linestyles='--')
         ax[mapper[g]].plot(time, convolved, '--', color='red', lw=2,
                            label=f'inferred mixture')
         # set upper limit
@@ -839,14 +1025,18 @@ def convert_HPLC_Zurich(foldername, raw_files):
 
     os.makedirs(foldername + '/converted', exist_ok=True)
     for i in range(len(raw_files)):
-        # Create dataframe from the output file
-        raw_data = pd.read_csv(raw_files[i], sep="\t", names=['time_min', 'step', 'intensity_mV'])
-        raw_data = raw_data.drop(raw_data.index[range(40)])
-
-        for x in range(len(raw_data)):                                #!!!! original 2400
-            raw_data.iloc[x, 2] = raw_data.iloc[x, 2].replace("- ", "-")
-        raw_data = raw_data.replace({"'": ""}, regex=True)
-        raw_data = raw_data.astype(float)
+        # Create dataframe from the output file, kept as text so the number format can be
+        # fixed below. The 40 header rows are dropped after parsing, not skipped as raw
+        # lines: blank lines are not rows and a quoted field spanning lines is one row
+        raw_data = pd.read_csv(raw_files[i], sep="\t", names=['time_min', 'step', 'intensity_mV'],
+                               engine='c', dtype='string')
+        raw_data = raw_data.iloc[40:]
+
+        # Fix the number format with vectorized string ops: "- 1.2" -> "-1.2"
+        # for the intensities and no apostrophe separators
+        raw_data['intensity_mV'] = raw_data['intensity_mV'].str.replace("- ", "-", regex=False)
+        for col in ['time_min', 'step', 'intensity_mV']:
+            raw_data[col] = raw_data[col].str.replace("'", "", regex=False).astype(np.float32)
 
         # Create a new folder with csv files with only the chromatogram values
         raw_data.to_csv(foldername + '/converted/' + raw_files[i].replace(foldername, '').replace('.txt', '') + '.csv',
@@ -854,345 +1044,312 @@ def convert_HPLC_Zurich(foldername, raw_files):
 
 
 ##UPLC Script#######################################################################################
-# function to replace apostrophes with empty string
-def process_file(file_path):
-    # opens file
-    with open(file_path, 'r') as file:
-        text = file.read()
-
-    # replace apostrophes with empty string
-    text = text.replace("'", "")
-
-    # writes object to file
-    with open(os.path.splitext(file_path)[0] + '.txt', 'w') as file:
-        file.write(text)
-
-    print(f"Processing file {file_path}")
-
-
-# Path to the folder containing the files
-folder_path = "raw"
-
-# Loop through all the files in the folder
-for file_path in glob.glob(os.path.join(folder_path, "*.txt")):
-    if os.path.isfile(file_path):
-        # Call your function on the file
-        process_file(file_path)
-
-# Path to the folder containing the calibration files
-folder_path = "bin/cal"
-
-# Loop through all the files in the folder
-for file_path in glob.glob(os.path.join(folder_path, "*.txt")):
-    if os.path.isfile(file_path):
-        # Call your function on the file
-        process_file(file_path)
-
-########################################
-print ('########')
-
-#set variables for analysis of HPLC data
-foldername_cal ='cal'       #foldername for calibration
-foldername_raw = 'raw'      #foldername for data
-
-peaks = ['glutamate', 'internal standard', 'glutamine', 'citrulline', 'arginine', 'GABA',
-         'alanine', 'NH4Cl', 'valine', 'tryptophan', 'isoleucine', 'leucine-phenylalanine', 'ornithine' ]#Set which peaks to quantify
-
-#set retention time for each compound for each round
-RT_peaks = [1.433, 1.886, 3.293, 5.940, 6.406, 7.493,
-            7.906, 10.020, 12.653, 13.880, 14.186, 14.480, 15.433]
-
-########################################
-print ('########')
-# convert files for calibration
-
-raw_hplc_files = glob.glob(foldername_cal+'/*.txt')
-print(foldername_cal+'/*.txt')
-print(raw_hplc_files)
-convert_HPLC_Zurich(foldername_cal, raw_hplc_files)
-
-#boundpars=[0.5,0.01,0.0,-0.1,1.6,0.01,2,0.1] #set boundaries of fitting
-boundpars=[0,0.03,0,-10,1000,0.03,0.1,10] # [0,0.01,0,-0.1,1000,0.01,0.5,0.1]
-#1. min. amplitude of peak height (multiplication of amplitude of detected peak position)
-#2. min. position of peak (offset of detected peak position to the left)
-#3. min. width of fitted peak
-#4. min. value of skew parameter
-#5. max. amplitude of peak height (multiplication of amplitude of detected peak position)
-#6. max. position of peak (offset of detected peak position to the right)
-#7. max. width of fitted peak-> if too high will itefere with peak resolution
-#8. max. value of skew parameter
-
-
-#run and detect peaks
-
-data_files = sorted(glob.glob(foldername_cal+'/converted/*.csv'))
-plot_dir = os.getcwd() + '/plots'
-os.makedirs(plot_dir, exist_ok=True)
-
-data_chroms, data_peaks, data_plot = batch_process(data_files,show_viz=False, plot_output = plot_dir + '/ plots',  time_window=[0, 23], manual_peak_positions=RT_peaks, backgroundsubstraction=True,backgroundsubstraction_iterations = 50, boundpars=boundpars)
-
-#calculate standard deviation of internal standard
-filtered_data = data_peaks[data_peaks['peak_idx'] == 3]   #!!!!!!
-area_std = np.std(filtered_data['area'])
-area_mean = np.mean(filtered_data['area'])
-cv = (area_std / area_mean) * 100
-
-#prints                                             ## display function is specific to IPython -> changed to print()
-print("Detected peaks")
-print(data_peaks)
-print('Internal standard')
-print('Standard Deviation:', area_std,'Mean:', area_mean, 'Coefficent of Variation:', cv)
-print(data_peaks.info())
-
-#########
-print ('########')
-for s in data_peaks['sample'].values:
-    # Split the file name by underscores
-    split = s.split('_')
-    sample = split[0].split()[0]
-    sample = sample.replace('converted\\','')
-    data_peaks.loc[data_peaks['sample'] == s, 'sample'] = sample
-
-#print(data_peaks)
-
-######
-print ('########')
-data_peaks.to_csv(foldername_cal + '.csv', index=False)
-# get list with concentration and peak intensity
-concs = []
-# Loop through each sample name
-for s in data_peaks['sample'].values:
-    # Split the file name by underscores
-    split = s.split('_')
-    # print(split)
-    ## Take only the last item that was split by an underscore and remove the mM
-    concentration = split[0].split('mM')[0]
-    concentration = concentration.replace('converted\\', '')
-    ## Add the concentration to the storage list as a float
-
-    concs.append(float(concentration))
-
-# Add the concentration as a new column in the data.
-data_peaks.loc[:, 'concentration_mM'] = concs  # warning
-
-####
-print ('########')
-#adding json directory (not needed in Ipython)
-json_dir = os.getcwd() + '/json'
-os.makedirs(json_dir, exist_ok=True)
-
+def main(n_jobs=None):
+    """
+    Run the full UPLC workflow in the current working directory: convert and fit the
+    calibration runs in ``cal``, save one calibration curve per compound, then convert,
+    fit and quantify the measurements in ``raw``.
 
-error = 0.05
-data_peaks_index = data_peaks.columns.tolist()
-
-#for each expected compound
-for compound_i in range(0,len(peaks)):
-    data_subset = pd.DataFrame(columns = data_peaks_index)
-    idx = 0
+    Parameters
+    ----------
+    n_jobs : int or None
+        Number of worker processes used by batch_process for each folder. Default
+        is `None`, one process per CPU, while batch_process itself stays serial
+        unless asked. When run as a script, the ``UPLC_N_JOBS`` environment
+        variable sets it, e.g. ``UPLC_N_JOBS=1`` for a serial run.
+    """
+    ########################################
+    print ('########')
+
+    #set variables for analysis of HPLC data
+    foldername_cal ='cal'       #foldername for calibration
+    foldername_raw = 'raw'      #foldername for data
+
+    peaks = ['glutamate', 'internal standard', 'glutamine', 'citrulline', 'arginine', 'GABA',
+             'alanine', 'NH4Cl', 'valine', 'tryptophan', 'isoleucine', 'leucine-phenylalanine', 'ornithine' ]#Set which peaks to quantify
+
+    #set retention time for each compound for each round
+    RT_peaks = [1.433, 1.886, 3.293, 5.940, 6.406, 7.493,
+                7.906, 10.020, 12.653, 13.880, 14.186, 14.480, 15.433]
+
+    ########################################
+    print ('########')
+    # convert files for calibration
+
+    raw_hplc_files = glob.glob(foldername_cal+'/*.txt')
+    print(foldername_cal+'/*.txt')
+    print(raw_hplc_files)
+    convert_HPLC_Zurich(foldername_cal, raw_hplc_files)
+
+    #boundpars=[0.5,0.01,0.0,-0.1,1.6,0.01,2,0.1] #set boundaries of fitting
+    boundpars=[0,0.03,0,-10,1000,0.03,0.1,10] # [0,0.01,0,-0.1,1000,0.01,0.5,0.1]
+    #1. min. amplitude of peak height (multiplication of amplitude of detected peak position)
+    #2. min. position of peak (offset of detected peak position to the left)
+    #3. min. width of fitted peak
+    #4. min. value of skew parameter
+    #5. max. amplitude of peak height (multiplication of amplitude of detected peak position)
+    #6. max. position of peak (offset of detected peak position to the right)
+    #7. max. width of fitted peak-> if too high will itefere with peak resolution
+    #8. max. value of skew parameter
+
+
+    #run and detect peaks
+
+    data_files = sorted(glob.glob(foldername_cal+'/converted/*.csv'))
+    plot_dir = os.getcwd() + '/plots'
+    os.makedirs(plot_dir, exist_ok=True)
+
+    data_chroms, data_peaks, data_plot = batch_process(data_files,show_viz=False, plot_output = plot_dir + '/ plots',  time_window=[0, 23], manual_peak_positions=RT_peaks, backgroundsubstraction=True,backgroundsubstraction_iterations = 50, boundpars=boundpars, n_jobs=n_jobs)
+
+    #calculate standard deviation of internal standard
+    filtered_data = data_peaks[data_peaks['peak_idx'] == 3]   #!!!!!!
+    area_std = np.std(filtered_data['area'])
+    area_mean = np.mean(filtered_data['area'])
+    cv = (area_std / area_mean) * 100
+
+    #prints                                             ## display function is specific to IPython -> changed to print()
+    print("Detected peaks")
+    print(data_peaks)
+    print('Internal standard')
+    print('Standard Deviation:', area_std,'Mean:', area_mean, 'Coefficent of Variation:', cv)
+    print(data_peaks.info())
+
+    #########
+    print ('########')
+    # Shorten the sample names in one pass: text before the first underscore, up to
+    # the first whitespace, without the Windows 'converted\' prefix
+    data_peaks['sample'] = (data_peaks['sample'].str.split('_').str[0]
+                            .str.split().str[0]
+                            .str.replace('converted\\', '', regex=False))
+
+    #print(data_peaks)
+
+    ######
+    print ('########')
+    data_peaks.to_csv(foldername_cal + '.csv', index=False)
+    # Add the concentration as a new column in the data: the part of the sample
+    # name before the first underscore, with the mM removed
+    data_peaks['concentration_mM'] = (data_peaks['sample'].str.split('_').str[0]
+                                      .str.split('mM').str[0]
+                                      .str.replace('converted\\', '', regex=False)
+                                      .astype(float))
+
+    ####
+    print ('########')
+    #adding json directory (not needed in Ipython)
+    json_dir = os.getcwd() + '/json'
+    os.makedirs(json_dir, exist_ok=True)
 
-    #get subset of peaks which fall in the expected RT interval
-    for peak_i in range(0,len(data_peaks)):
-        current_peak_RT = data_peaks['retention_time'].iloc[peak_i]
-        if (RT_peaks[compound_i] - error) <= current_peak_RT <= (RT_peaks[compound_i] + error):
-            data_subset.loc[idx] = list(data_peaks.iloc[peak_i])
-            idx = idx + 1
-
-    #check that there are peaks at the expected RT in all calibration samples
-    if len(data_subset) == len(data_peaks['sample'].unique()):
-        print('Full calibration at retention time ',RT_peaks[compound_i] , ' corresponding to ',peaks[compound_i])
-        # perform linear regression for the compound
-        output = scipy.stats.linregress(data_subset['area'], data_subset['concentration_mM'])
-
-        # Extract slope, intercept, and r-value from output tuple
-        slope = output[0]
-        intercept = output[1]
-        r_value = output[2]
-
-        # Print results
-        print("******Calibration curve for ", peaks[compound_i], "*****")
-        print("Slope:", slope)
-        print("Intercept:", intercept)
-        print("R-squared:", r_value ** 2)
 
-        # Create dictionary to store calibration results
-        json_par = {
-            "slope": slope,
-            "intercept": intercept,
-            "r_squared": r_value ** 2
-        }
+    error = 0.05
+    data_peaks_rt = data_peaks['retention_time'].to_numpy()
 
-        # Serialize dictionary to JSON format
-        calibration = json.dumps(json_par, indent=2)
+    #for each expected compound
+    for compound_i in range(0,len(peaks)):
+        #get subset of peaks which fall in the expected RT interval
+        in_window = ((RT_peaks[compound_i] - error) <= data_peaks_rt) & (data_peaks_rt <= (RT_peaks[compound_i] + error))
+        data_subset = data_peaks.iloc[np.flatnonzero(in_window)].reset_index(drop=True)
 
-        # Define output file name
-        outjson = f"json/calibration_{peaks[compound_i]}.json"
+        #check that there are peaks at the expected RT in all calibration samples
+        if len(data_subset) == len(data_peaks['sample'].unique()):
+            print('Full calibration at retention time ',RT_peaks[compound_i] , ' corresponding to ',peaks[compound_i])
+            # perform linear regression for the compound
+            output = scipy.stats.linregress(data_subset['area'], data_subset['concentration_mM'])
 
-        # Write calibration results to file
-        with open(outjson, "w") as jsonFile:
-            json.dump(json_par, jsonFile)
+            # Extract slope, intercept, and r-value from output tuple
+            slope = output[0]
+            intercept = output[1]
+            r_value = output[2]
 
-        print("Calibration curve saved as:", outjson)
+            # Print results
+            print("******Calibration curve for ", peaks[compound_i], "*****")
+            print("Slope:", slope)
+            print("Intercept:", intercept)
+            print("R-squared:", r_value ** 2)
 
-        # Set up a range of areas to plot
-        area_range = np.linspace(0, 1.1 * data_subset['area'].max(), 300)
+            # Create dictionary to store calibration results
+            json_par = {
+                "slope": slope,
+                "intercept": intercept,
+                "r_squared": r_value ** 2
+            }
 
-        # Compute the calibration curve for plotting
-        fit = intercept + slope * area_range
+            # Serialize dictionary to JSON format
+            calibration = json.dumps(json_par, indent=2)
 
-        # Create a new figure for the plot
-        plt.figure()
+            # Define output file name
+            outjson = f"json/calibration_{peaks[compound_i]}.json"
 
-        # Plot the data points and the calibration curve
-        plt.plot(area_range, fit, 'k-', label='fit')
-        plt.plot(data_subset['area'], data_subset['concentration_mM'], 'o')
+            # Write calibration results to file
+            with open(outjson, "w") as jsonFile:
+                json.dump(json_par, jsonFile)
 
-        # Add a legend and axis labels
-        plt.legend()
-        plt.xlabel('Value [a.u.]')
-        plt.ylabel('concentration [mM]')
+            print("Calibration curve saved as:", outjson)
 
-        # Set the title of the plot to include the peak_idx value
-        plt.title('Calibration curve for ' + peaks[compound_i])
+            # Set up a range of areas to plot
+            area_range = np.linspace(0, 1.1 * data_subset['area'].max(), 300)
 
-        # Save the plot to a file
-        plt.savefig('plots/peak_' + peaks[compound_i] + '_calibration.png')
+            # Compute the calibration curve for plotting
+            fit = intercept + slope * area_range
 
-        # Show the plot
-        #plt.show()
+            # Create a new figure for the plot
+            plt.figure()
 
-    elif len(data_subset) > len(data_peaks['sample'].unique()):
-        print('error: calibration peak number at retention time ',RT_peaks[compound_i] , ' corresponding to ',peaks[compound_i] ,'higher than expected.')
+            # Plot the data points and the calibration curve
+            plt.plot(area_range, fit, 'k-', label='fit')
+            plt.plot(data_subset['area'], data_subset['concentration_mM'], 'o')
 
-    elif len(data_subset) < len(data_peaks['sample'].unique()):
-        print('error: calibration peak number at retention time ',RT_peaks[compound_i] , ' corresponding to ',peaks[compound_i] ,'lower than expected.')
+            # Add a legend and axis labels
+            plt.legend()
+            plt.xlabel('Value [a.u.]')
+            plt.ylabel('concentration [mM]')
 
+            # Set the title of the plot to include the peak_idx value
+            plt.title('Calibration curve for ' + peaks[compound_i])
 
-####
-print ('########')
+            # Save the plot to a file
+            plt.savefig('plots/peak_' + peaks[compound_i] + '_calibration.png')
 
-#convert files of measurement
+            # Show the plot
+            #plt.show()
 
-raw_hplc_files = glob.glob(foldername_raw+'/*.txt')
-print(raw_hplc_files)
-convert_HPLC_Zurich(foldername_raw, raw_hplc_files)
+        elif len(data_subset) > len(data_peaks['sample'].unique()):
+            print('error: calibration peak number at retention time ',RT_peaks[compound_i] , ' corresponding to ',peaks[compound_i] ,'higher than expected.')
 
-#boundpars defined earlier in script
+        elif len(data_subset) < len(data_peaks['sample'].unique()):
+            print('error: calibration peak number at retention time ',RT_peaks[compound_i] , ' corresponding to ',peaks[compound_i] ,'lower than expected.')
 
 
-data_files = sorted(glob.glob(foldername_raw+'/converted/*.csv'))
-plot_dir = os.getcwd() + '/plots'
+    ####
+    print ('########')
 
-data_chroms, data_peaks, data_plot = batch_process(data_files, show_viz=False, plot_output = plot_dir + '/plots', plot_show = False, time_window=[0, 23],
-                                                                  manual_peak_positions=RT_peaks, backgroundsubstraction=True,
-                                                                  backgroundsubstraction_iterations = 50, boundpars=boundpars)
+    #convert files of measurement
 
-print("Detected peaks")
-print(data_peaks)
-print(data_peaks.info())
+    raw_hplc_files = glob.glob(foldername_raw+'/*.txt')
+    print(raw_hplc_files)
+    convert_HPLC_Zurich(foldername_raw, raw_hplc_files)
 
-####
-print ('########')
+    #boundpars defined earlier in script
 
-#calculate standard deviation of internal standard
-filtered_data = data_peaks[data_peaks['peak_idx'] == 3] #!!!!!!!
-area_std = np.std(filtered_data['area'])
-area_mean = np.mean(filtered_data['area'])
-cv = (area_std / area_mean) * 100
 
-print('Internal standard')
-print('Standard Deviation:', area_std,'Mean:', area_mean, 'Coefficent of Variation:', cv)
+    data_files = sorted(glob.glob(foldername_raw+'/converted/*.csv'))
+    plot_dir = os.getcwd() + '/plots'
 
-####
-print ('########')
+    data_chroms, data_peaks, data_plot = batch_process(data_files, show_viz=False, plot_output = plot_dir + '/plots', plot_show = False, time_window=[0, 23],
+                                                                      manual_peak_positions=RT_peaks, backgroundsubstraction=True,
+                                                                      backgroundsubstraction_iterations = 50, boundpars=boundpars, n_jobs=n_jobs)
 
-for s in data_peaks['sample'].values:
-    # Split the file name by underscores
-    split = s.split('_')
-    sample = split[0].split()[0]
-    sample = sample.replace('converted\\','')
-    data_peaks.loc[data_peaks['sample'] == s, 'sample'] = sample
+    print("Detected peaks")
+    print(data_peaks)
+    print(data_peaks.info())
 
-print(data_peaks)
+    ####
+    print ('########')
 
-####
-print ('########')
-#make result directory
-result_dir = os.getcwd() + '/result'
-os.makedirs(result_dir, exist_ok=True)
+    #calculate standard deviation of internal standard
+    filtered_data = data_peaks[data_peaks['peak_idx'] == 3] #!!!!!!!
+    area_std = np.std(filtered_data['area'])
+    area_mean = np.mean(filtered_data['area'])
+    cv = (area_std / area_mean) * 100
 
+    print('Internal standard')
+    print('Standard Deviation:', area_std,'Mean:', area_mean, 'Coefficent of Variation:', cv)
 
-# This code can be used for quantification of each compound in each sample
-# go through samples and find specific peaks
+    ####
+    print ('########')
 
-samplelist = data_peaks['sample'].unique()
+    # Shorten the sample names in one pass: text before the first underscore, up to
+    # the first whitespace, without the Windows 'converted\' prefix
+    data_peaks['sample'] = (data_peaks['sample'].str.split('_').str[0]
+                            .str.split().str[0]
+                            .str.replace('converted\\', '', regex=False))
 
-all_unid_peaks = pd.DataFrame(columns = data_peaks.columns.tolist())
+    print(data_peaks)
 
-# Set which peaks to quantify
-#peaks = ['glutamic acid', 'internal standard', 'glutamine', 'alanine', 'citrulline', 'arginine', 'GABA', 'ammonium','valine', 'tryptophan', 'isoleucine', 'leu_phe', 'ornithine']
+    ####
+    print ('########')
+    #make result directory
+    result_dir = os.getcwd() + '/result'
+    os.makedirs(result_dir, exist_ok=True)
 
-# for each sample to analyse
-for sample in samplelist:
-    #initialise empty variables
-    compounds = []
-    concentration = []
-    unidentified_idx = []
-    identified_idx = []
-    id_output = {}
 
-    #extract information about identified peaks for this sample
-    data_selection = data_peaks.loc[data_peaks['sample'] == sample]
+    # This code can be used for quantification of each compound in each sample
+    # go through samples and find specific peaks
 
-    # initialise empty dataframes with same indices as data_selection
-    data_sel_index = data_selection.columns.tolist()
-    identified_peak_data = pd.DataFrame(columns = data_sel_index)
-    unidentified_peak_data = pd.DataFrame(columns = data_sel_index)
+    samplelist = data_peaks['sample'].unique()
 
-    # error margin in RT allowed for the identification of each peak
-    error = 0.05
+    all_unid_peaks = pd.DataFrame(columns = data_peaks.columns.tolist())
 
-    #list of compounds for which a calibration curve has been determined
-    cal_curves = glob.glob('json/'+'/*.json')
-    cal_comp = []
-    for cal in range(0,len(cal_curves)):
-        cal_comp.append(cal_curves[cal].replace('json/calibration_', '').replace('.json', ''))
-
-
-    # for each peak in this sample:
-    for i in range(0, len(data_selection)):
-        current_RT = data_selection.iloc[i]['retention_time']
-
-        #check if peak falls in range of RT of expected compounds +- error margin defined above
-        for j in range(0, len(RT_peaks)):
-            if peaks[j] in cal_comp:
-                if (RT_peaks[j] - error) <= current_RT <= (RT_peaks[j] + error):
-                    compounds.append(peaks[j])
-                    identified_idx.append(i)
-                    identified_peak_data.loc[len(compounds)-1] = list(data_selection.iloc[i]) #not the most elegant solution
-
-                    #get calibration curve information
-                    with open("json/calibration_" + peaks[j] + ".json", "r") as jsonFile:
-                        cal_data = json.load(jsonFile)
-                        slope = cal_data["slope"]
-                        intercept = cal_data["intercept"]
-
-                    #using area of current peak and information from calibration curve, calculate concentration of compound
-                    concentration.append((data_selection.iloc[i]['area'] - intercept)/np.abs(slope))
-                    break
+    # Set which peaks to quantify
+    #peaks = ['glutamic acid', 'internal standard', 'glutamine', 'alanine', 'citrulline', 'arginine', 'GABA', 'ammonium','valine', 'tryptophan', 'isoleucine', 'leu_phe', 'ornithine']
+
+    #calibration curves determined above, loaded once as compound -> (slope, intercept)
+    cal_table = {}
+    for cal_file in glob.glob('json/calibration_*.json'):
+        with open(cal_file, "r") as jsonFile:
+            cal_data = json.load(jsonFile)
+        cal_table[os.path.basename(cal_file)[len('calibration_'):-len('.json')]] = (cal_data["slope"], cal_data["intercept"])
+
+    #expected RT of each compound and whether a calibration curve exists for it
+    rt_expected = np.array(RT_peaks)
+    calibrated = np.array([peaks[j] in cal_table for j in range(0, len(RT_peaks))])
+    #calibrated compounds sorted by expected RT, for the searchsorted lookup below
+    cal_idx = np.flatnonzero(calibrated)
+    cal_idx = cal_idx[np.argsort(rt_expected[cal_idx], kind='stable')]
+
+    # for each sample to analyse
+    for sample in samplelist:
+        #initialise empty variables
+        compounds = []
+        concentration = []
+        identified_idx = []
+        id_output = {}
+
+        #extract information about identified peaks for this sample
+        data_selection = data_peaks.loc[data_peaks['sample'] == sample]
+
+        # error margin in RT allowed for the identification of each peak
+        error = 0.05
+
+        # check all peaks of this sample against the RT of all calibrated compounds
+        # +- error margin defined above; each peak takes the first listed compound in range.
+        # The compounds in range of a peak are the slice start:stop of cal_idx, and with no
+        # calibrated compounds every slice is empty
+        rt_sel = data_selection['retention_time'].to_numpy()
+        area_sel = data_selection['area'].to_numpy()
+        start = np.searchsorted(rt_expected[cal_idx] + error, rt_sel, side='left')
+        stop = np.searchsorted(rt_expected[cal_idx] - error, rt_sel, side='right')
+        unidentified_idx = []
+
+        for i in range(len(rt_sel)):
+            if start[i] >= stop[i]:
+                # if peak does not fall in range -> mark as unidentified
+                unidentified_idx.append(i)
+                continue
+            j = cal_idx[start[i]:stop[i]].min()
+            compounds.append(peaks[j])
+            identified_idx.append(i)
+
+            #get calibration curve information
+            slope, intercept = cal_table[peaks[j]]
+
+            #using area of current peak and information from calibration curve, calculate concentration of compound
+            concentration.append((area_sel[i] - intercept)/np.abs(slope))
+
+        #extract peak information about identified and unidentified peaks in one gather each
+        identified_peak_data = data_selection.iloc[identified_idx].reset_index(drop=True)
+        unidentified_peak_data = data_selection.iloc[unidentified_idx].reset_index(drop=True)
 
-        # if peak does not fall in range -> mark as unidentified
-        if i not in identified_idx:
-            unidentified_idx.append(i)
+        id_output = {'compound': compounds, 'concentration (mM)': concentration}
+        id_output = pd.DataFrame(data=id_output)  #####this is far from optimal
+        id_output = pd.concat([id_output,identified_peak_data], axis = 1)
 
-    #extract peak information about unidentified peaks
-    for k in range(0, len(unidentified_idx)):
-        unidentified_peak_data.loc[k] = list(data_selection.iloc[unidentified_idx[k]])
 
-    id_output = {'compound': compounds, 'concentration (mM)': concentration}
-    id_output = pd.DataFrame(data=id_output)  #####this is far from optimal
-    id_output = pd.concat([id_output,identified_peak_data], axis = 1)
+        # Save the data_peaks dataframe for this sample to a csv file
+        id_output.to_csv('result/' + sample + '_output.csv', index=False)
+        unidentified_peak_data.to_csv('result/' + sample + '_unidentified_peaks.csv', index=False)
 
 
-    # Save the data_peaks dataframe for this sample to a csv file
-    id_output.to_csv('result/' + sample + '_output.csv', index=False)
-    unidentified_peak_data.to_csv('result/' + sample + '_unidentified_peaks.csv', index=False)
\ No newline at end of file
+if __name__ == '__main__':
+    n_jobs = os.environ.get('UPLC_N_JOBS')
+    main(n_jobs=int(n_jobs) if n_jobs else None)
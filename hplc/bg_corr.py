@@ -4,39 +4,126 @@ import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from pathlib import Path
 import os
+import math
 
-def perform_background_correction(dataframe: pd.DataFrame, file_name, file_path):
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, the smoothing then runs on NumPy slices
+    njit = None
+
+
+# LLS operator and its inverse, evaluated in place on the output buffer; the forward
+# transform also shifts the absorbance and clips it at zero in place first
+def _lls_forward(a, shift, out):
+    a -= shift
+    np.maximum(a, 0, out=a)
+    np.add(a, 1, out=out)
+    np.sqrt(out, out=out)
+    out += 1
+    np.log(out, out=out)
+    out += 1
+    np.log(out, out=out)
+    return out
+
+
+def _lls_inverse(t, out):
+    np.exp(t, out=out)
+    out -= 1
+    np.exp(out, out=out)
+    out -= 1
+    np.square(out, out=out)
+    out -= 1
+    return out
+
+
+# LLS smoothing: each pass i clips every point to the mean of its neighbours
+# i steps away, with all points of a pass reading the previous pass
+def _lls_smooth(tform, n_iter):
+    out = tform.copy()
+    scratch = np.empty_like(out)
+    n = out.shape[0]
+    for i in range(1, n_iter + 1):
+        if n - 2 * i <= 0:
+            break
+        # neighbour means into a reused buffer, then clip in place
+        mean = scratch[:n - 2 * i]
+        np.add(out[2 * i:], out[:-2 * i], out=mean)
+        mean *= 0.5
+        np.minimum(out[i:-i], mean, out=out[i:-i])
+    return out
+
+
+if njit is not None:
+    @njit(cache=True, fastmath=True, boundscheck=False)
+    def _lls_smooth(tform, n_iter):
+        # two buffers swapped each pass: prev holds the last pass, out receives the next
+        out = tform.copy()
+        prev = tform.copy()
+        n = out.shape[0]
+        for i in range(1, n_iter + 1):
+            if n - 2 * i <= 0:
+                break
+            out, prev = prev, out
+            # only the borders of the older buffer are stale
+            for j in range(i):
+                out[j] = prev[j]
+                out[n - 1 - j] = prev[n - 1 - j]
+            for j in range(i, n - i):
+                v = 0.5 * (prev[j + i] + prev[j - i])
+                out[j] = v if v < prev[j] else prev[j]
+        return out
+
+    # the transforms in one pass per element, all nested functions in registers;
+    # no fastmath on the forward pass, so the shift and clip round exactly as in NumPy
+    @njit(cache=True, parallel=True)
+    def _lls_forward(a, shift, out):
+        for i in prange(a.shape[0]):
+            a[i] = max(a[i] - shift, 0.0)
+            out[i] = math.log(math.log(math.sqrt(a[i] + 1.0) + 1.0) + 1.0)
+        return out
+
+    @njit(cache=True, fastmath=True, parallel=True)
+    def _lls_inverse(t, out):
+        for i in prange(t.shape[0]):
+            e = math.exp(math.exp(t[i]) - 1.0) - 1.0
+            out[i] = e * e - 1.0
+        return out
+
+    # compile (or load from cache) for the float64 path at import, so the first
+    # chromatogram does not pay for it
+    _warmup = np.zeros(16, dtype=np.float64)
+    _lls_inverse(_lls_smooth(_lls_forward(_warmup, 0.0, np.empty_like(_warmup)), 1), np.empty_like(_warmup))
+    del _warmup
+
+
+def perform_background_correction(dataframe: pd.DataFrame, file_name, file_path, plot=True):
     
     # Extract Time (min) and Value (mAU) columns
-    time = dataframe.copy()['Time (min)'].values
-    absorbance = dataframe.copy()['Value (mAU)'].values
+    time = dataframe['Time (min)'].to_numpy()
+    absorbance = dataframe['Value (mAU)'].to_numpy(dtype=np.float64, copy=True)  # modified in place below
     if (absorbance < 0).any():
-        shift = np.median(absorbance[absorbance < 0])
+        shift = float(np.median(absorbance[absorbance < 0]))
     else:
-        shift = 0
-    absorbance -= shift
-    absorbance *= np.heaviside(absorbance, 0)
-    # Compute the LLS operator
-    tform = np.log(np.log(np.sqrt(absorbance + 1) + 1) + 1)
+        shift = 0.0
+    # Shifting and clipping the absorbance happen in the same pass as the transform
+    tform = _lls_forward(absorbance, shift, np.empty_like(absorbance))
 
     # Compute the number of iterations given the window size.
     n_iter = 20
 
-    for i in range(1, n_iter + 1):
-        tform_new = tform.copy()
-        for j in range(i, len(tform) - i):
-            tform_new[j] = min(tform_new[j], 0.5 *
-                                (tform_new[j+i] + tform_new[j-i]))
-        tform = tform_new
+    tform = _lls_smooth(tform, n_iter)
 
     # Perform the inverse of the LLS transformation and subtract
-    inv_tform = ((np.exp(np.exp(tform) - 1) - 1)**2 - 1)
+    inv_tform = _lls_inverse(tform, tform)
     baseline_corrected = np.round(
         (absorbance - inv_tform), decimals=9)
     baseline = inv_tform + shift
 
-    # Create and save the plots as PNG files
-    plt.figure(figsize=(12, 8))
+    if not plot:
+        return baseline_corrected, baseline
+
+    # Create and save the plots as PNG files, redrawing the same figure for every file
+    plt.figure('background correction', figsize=(12, 8)).clear()
     gs = gridspec.GridSpec(2, 1, height_ratios=[1, 1])
 
     # Plotting chromatogram before background correction
@@ -64,6 +151,5 @@ def perform_background_correction(dataframe: pd.DataFrame, file_name, file_path)
 
     # Save the plot as a PNG file
     plt.savefig(os.path.join(bg_dir, f'{os.path.splitext(file_name)[0]}_background_correction.png'))
-    plt.close('all')
     
     return baseline_corrected, baseline
\ No newline at end of file
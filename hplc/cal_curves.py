@@ -1,41 +1,54 @@
 import os
 import matplotlib.pyplot as plt
 import pandas as pd
-from scipy.stats import linregress
+import numpy as np
 from pathlib import Path
 
-def calibrate(all_compounds, file_path):
+def calibrate(all_compounds, file_path, plot=True):
+    # all_compounds holds one CompoundBatch per calibration file; stack their arrays
     compounds_df = pd.DataFrame(
-        {'Name': [compound.name for compound in all_compounds],
-        'Concentration (mM)': [compound.concentration for compound in all_compounds],
-        'Area': [compound.area for compound in all_compounds]})
+        {'Name': [name for batch in all_compounds for name in batch.names],
+        'Concentration (mM)': np.repeat(np.array([batch.concentration for batch in all_compounds], dtype=np.float64),
+                                        [len(batch) for batch in all_compounds]),
+        'Area': np.concatenate([batch.areas for batch in all_compounds]) if all_compounds else []})
 
     # Create and plot individual calibration curves in separate subplots
-    unique_compounds = compounds_df['Name'].unique()
-    num_compounds = len(unique_compounds)
-    plt.figure(figsize=(15, 10))
+    num_compounds = compounds_df['Name'].nunique()
 
     # Create the "plots" directory if it doesn't exist
     cal_dir = Path(file_path / 'plots' / 'calibration_curves')
-    os.makedirs(cal_dir, exist_ok=True)
+    if plot:
+        os.makedirs(cal_dir, exist_ok=True)
     
     slope_intercept_values = {}
 
-    for idx, compound_name in enumerate(unique_compounds, start=1):
-        plt.figure(figsize=(8, 6))
-        plt.scatter(compounds_df.loc[compounds_df['Name'] == compound_name, 'Concentration (mM)'],
-                    compounds_df.loc[compounds_df['Name'] == compound_name, 'Area'],
-                    label=f'{compound_name} Calibration Curve',
-                    color=plt.cm.jet(idx / num_compounds))
-        
+    # One pass over the frame, keeping the compounds in order of first appearance
+    for idx, (compound_name, group) in enumerate(compounds_df.groupby('Name', sort=False), start=1):
+        concentrations = group['Concentration (mM)'].to_numpy()
+        areas = group['Area'].to_numpy()
+
         # Fit a linear equation to the concentration-peak area relationship
-        slope, intercept, rvalue, _, _ = linregress(compounds_df.loc[compounds_df['Name'] == compound_name, 'Concentration (mM)'],
-                                               compounds_df.loc[compounds_df['Name'] == compound_name, 'Area'])
+        # by least squares on the centred sums; only slope, intercept and r are used
+        dx = concentrations - concentrations.mean()
+        dy = areas - areas.mean()
+        sxx, sxy, syy = dx @ dx, dx @ dy, dy @ dy
+        if sxx == 0:
+            raise ValueError(f'Cannot fit a calibration curve for {compound_name}: all concentrations are identical')
+        slope = sxy / sxx
+        intercept = areas.mean() - slope * concentrations.mean()
+        rvalue = np.clip(sxy / np.sqrt(sxx * syy), -1.0, 1.0) if syy > 0 else 0.0
         slope_intercept_values[compound_name] = {'Slope': round(slope, 2), 'Intercept': round(intercept, 2), 'R-squared': round(rvalue ** 2, 4)}
+
+        if not plot:
+            continue
+
+        plt.figure('calibration curve', figsize=(8, 6)).clear()
+        plt.scatter(concentrations, areas,
+                    label=f'{compound_name} Calibration Curve',
+                    color=plt.cm.jet(idx / num_compounds))
         
         # Plot the fitted curve
-        plt.plot(compounds_df.loc[compounds_df['Name'] == compound_name, 'Concentration (mM)'],
-                 slope * compounds_df.loc[compounds_df['Name'] == compound_name, 'Concentration (mM)'] + intercept,
+        plt.plot(concentrations, slope * concentrations + intercept,
                  color='black', linestyle='--',
                  label=f'Fit: y = {slope:.4f}x + {intercept:.4f}')
 
@@ -46,6 +59,5 @@ def calibrate(all_compounds, file_path):
         
         # Save the plot as a PNG file
         plt.savefig(os.path.join(cal_dir, f'{compound_name}_calibration_curve.png'))
-        plt.close()
 
     return slope_intercept_values
\ No newline at end of file
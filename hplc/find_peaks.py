@@ -3,58 +3,106 @@ from scipy.signal import find_peaks
 import matplotlib.pyplot as plt
 import os
 from pathlib import Path
+from dataclasses import dataclass
+
+@dataclass
+class CompoundBatch:
+    # The compounds found in one chromatogram as parallel arrays, one entry per matched RT;
+    # concentration is set for calibration runs
+    names: list
+    indices: np.ndarray
+    areas: np.ndarray
+    rts: np.ndarray
+    concentration: float = None
+
+    def __len__(self):
+        return len(self.names)
 
-class Compound:
-    def __init__(self, index, name, area, rt):
-        self.index = index
-        self.name = name
-        self.area = area
-        self.rt = rt
-        
     def __str__(self):
-        return f"Peak: {self.name} (index: {self.index}) with retention time: {self.rt} min, total area: {self.area} mAU."
+        return '\n'.join(f"Peak: {name} (index: {index}) with retention time: {rt} min, total area: {area} mAU."
+                         for name, index, rt, area in zip(self.names, self.indices, self.rts, self.areas))
         
 
-def detect_and_highlight_peaks(time, baseline_corrected_data, retention_times: dict, filename, file_path):
+def match_retention_times(peak_times, keys, max_difference):
+    # Every RT, in order, takes the closest peak that is not taken yet if it lies within
+    # max_difference. Ties go to the first peak in peak_times, so with exactly equal
+    # differences the earlier peak wins, as in a linear argmin over the remaining peaks
+    keys = np.asarray(keys, dtype=np.float64)
+    matches = np.full(len(keys), -1)
+    if len(peak_times) == 0 or len(keys) == 0:
+        return matches
+
+    # The closest peak of every RT from one |peaks| x |RTs| difference matrix; as long as no
+    # two RTs claim the same peak, taking peaks in order cannot change any of them
+    diff = np.abs(peak_times[:, None] - keys[None, :])
+    nearest = diff.argmin(axis=0)
+    hit = diff[nearest, np.arange(len(keys))] <= max_difference
+    if len(np.unique(nearest[hit])) == np.count_nonzero(hit):
+        matches[hit] = nearest[hit]
+        return matches
+
+    # Otherwise match in order, masking the peaks already taken out of each RT's column
+    used = np.zeros(len(peak_times), dtype=bool)
+    for k in range(len(keys)):
+        difference = diff[:, k]
+        difference[used] = np.inf
+        peak_number = difference.argmin()
+        if not used[peak_number] and difference[peak_number] <= max_difference:
+            matches[k] = peak_number
+            used[peak_number] = True
+    return matches
+
+
+def detect_and_highlight_peaks(time, baseline_corrected_data, rt_keys, rt_names, filename, file_path, plot=True):
+    # rt_keys (sorted float array) and rt_names are the theoretical RTs and their compounds
     
+    # Work on plain arrays, so all indexing below is positional into the same samples
+    # find_peaks sees
+    time = np.asarray(time)
+    baseline_corrected_data = np.asarray(baseline_corrected_data, dtype=np.float64)
+
     # Find peaks in the baseline-corrected data
     peaks, prominences = find_peaks(baseline_corrected_data, prominence=1)
-    compound_list = []
+
+    # Cumulative trapezoid over the sample index, computed once for the whole chromatogram;
+    # the area between bases l and r is then cum[r - 1] - cum[l]
+    y = baseline_corrected_data
+    cum = np.concatenate(([0.0], np.cumsum(0.5 * (y[1:] + y[:-1]))))
     
-    for key, value in retention_times.items():
-        peak_number = np.argmin(np.abs(time[peaks] - key))
-        rt = time[peaks[peak_number]]
-        rt_difference = np.abs(rt - key)
-        if rt_difference <= 0.3:
-            peak_contour = range(prominences['left_bases'][peak_number], prominences['right_bases'][peak_number], 1)
-            area = np.round(np.trapz(baseline_corrected_data[peak_contour], peak_contour))
-            index = peaks[peak_number]
-            compound = Compound(index=index, name=value, area=area, rt=rt)
-            print(compound)
-            compound_list.append(compound)
-            peaks = np.delete(peaks, peak_number)
-            prominences['left_bases'] = np.delete(prominences['left_bases'], peak_number)
-            prominences['right_bases'] = np.delete(prominences['right_bases'], peak_number)
-        else:
-            continue
+    # Index of the peak matched to every RT, -1 if there is none within 0.3 min
+    peak_times = time[peaks]
+    matches = match_retention_times(peak_times, rt_keys, 0.3)
+
+    # Gather all matched peaks at once
+    found = np.flatnonzero(matches >= 0)
+    peak_numbers = matches[found]
+    compounds = CompoundBatch(names=[rt_names[k] for k in found],
+                              indices=peaks[peak_numbers],
+                              areas=np.round(cum[prominences['right_bases'][peak_numbers] - 1] - cum[prominences['left_bases'][peak_numbers]]),
+                              rts=peak_times[peak_numbers])
+    if len(compounds):
+        print(compounds)
+
+    if not plot:
+        return compounds
     
     # Create "peaks" subfolder in "plots" directory if it doesn't exist
     peaks_plots_dir = Path(file_path / 'plots' / 'peaks')
     os.makedirs(peaks_plots_dir, exist_ok=True)
     
     # Plotting chromatogram and highlighting peaks
-    plt.figure(figsize=(10, 6))
+    plt.figure('peaks', figsize=(10, 6)).clear()
     plt.plot(time, baseline_corrected_data, label='Chromatogram (Baseline Corrected)', color='blue')
     
     # Highlight peaks closest to retention times
-    for i in range(len(compound_list)):
-        x = time[compound_list[i].index]
-        y = baseline_corrected_data[compound_list[i].index]
+    for name, index in zip(compounds.names, compounds.indices):
+        x = time[index]
+        y = baseline_corrected_data[index]
         plt.scatter(x, y, color='green', marker='o')
-        plt.text(x*(1.01), y*(1.01), compound_list[i].name, fontsize=8)
+        plt.text(x*(1.01), y*(1.01), name, fontsize=8)
 
     # Mark manually provided retention times on the plot
-    plt.vlines(list(retention_times.keys()), ymin=min(baseline_corrected_data), ymax=max(baseline_corrected_data), colors='purple', linestyles='dashed', label='Theoretical retention Times')
+    plt.vlines(rt_keys, ymin=baseline_corrected_data.min(), ymax=baseline_corrected_data.max(), colors='purple', linestyles='dashed', label='Theoretical retention Times')
 
     plt.title('Chromatogram with Detected and Closest Peaks (Baseline Corrected)')
     plt.xlabel('Time (min)')
@@ -64,7 +112,4 @@ def detect_and_highlight_peaks(time, baseline_corrected_data, retention_times: d
     # Save the plot as a PNG file
     plt.savefig(os.path.join(peaks_plots_dir, f'peaks_{os.path.splitext(filename)[0]}.png'))
     
-    # Close the figure
-    plt.close()
-    
-    return compound_list
\ No newline at end of file
+    return compounds
\ No newline at end of file
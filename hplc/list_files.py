@@ -3,6 +3,9 @@ import re
 import shutil
 from pathlib import Path
 
+# Calibration files carry their concentration in the name, e.g. '0.5mM_cal.txt'
+_CAL_RE = re.compile(r'mM')
+
 def read_files(file_path):
     file_path = Path(file_path)
             
@@ -13,7 +16,7 @@ def read_files(file_path):
     
     for file in folder_contents:
         if file.endswith(".txt"):
-            match = re.search(r'(.*)mM', file)
+            match = _CAL_RE.search(file)
             if match:
                 cal_files.append(file)
             else:
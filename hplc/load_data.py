@@ -1,21 +1,36 @@
 import pandas as pd
 import numpy as np
 
+# Parse with pyarrow when it is installed, otherwise with pandas' C parser; either one only
+# sees the data section, so both return the same frame
+try:
+    import pyarrow  # noqa: F401
+    _CSV_ENGINE = 'pyarrow'
+except ImportError:
+    _CSV_ENGINE = 'c'
+
 def load_absorbance_data(file_path):
-    # Read the .txt file skipping initial rows until the 'Chromatogram Data' section
+    # Scan the .txt file only up to the 'Chromatogram Data' section, then parse the rest
+    # from the same handle, so the metadata above it is never tokenized as CSV
     with open(file_path, 'r') as file:
-        lines = file.readlines()
-        start_index = lines.index('Chromatogram Data:\n') + 2  # Find the start index of data
+        for line in file:
+            if line == 'Chromatogram Data:\n':
+                break
+        else:
+            raise ValueError(f"'Chromatogram Data:' not found in {file_path}")
 
-    # Convert lines into a Pandas DataFrame, skipping the first row as it contains headers
-    df = pd.read_csv(
-        file_path,
-        skiprows=start_index,
-        delimiter='\t',
-        names=['Time (min)', 'Step (s)', 'Value (mAU)'],
-    )
+        # Read the Time (min) and Value (mAU) columns straight into float64, skipping the
+        # column header and the first row of the data as it contains no step value
+        df = pd.read_csv(
+            file,
+            skiprows=2,
+            delimiter='\t',
+            names=['Time (min)', 'Step (s)', 'Value (mAU)'],
+            dtype={'Time (min)': np.float64, 'Value (mAU)': np.float64},
+            engine=_CSV_ENGINE,
+        )
 
     # Extract Time (min) and Value (mAU) columns
-    chromatogram_data = df[['Time (min)', 'Value (mAU)']][1:].astype(np.float64)
+    chromatogram_data = df[['Time (min)', 'Value (mAU)']]
 
-    return chromatogram_data
\ No newline at end of file
+    return chromatogram_data
@@ -1,3 +1,5 @@
+import matplotlib
+matplotlib.use('Agg')  # plots are only saved to files; set before pyplot is imported below
 from bg_corr import perform_background_correction
 from cal_curves import calibrate
 from find_peaks import detect_and_highlight_peaks
@@ -5,13 +7,28 @@ from list_files import read_files
 from calc_conc import calculate_concentration
 from load_data import load_absorbance_data
 import time
+import numpy as np
+import os
 from pathlib import Path
 import csv 
 import re
+import itertools
+import concurrent.futures
+import multiprocessing
+
+_CONC_RE = re.compile(r'(\d+(?:\.\d+)?)mM')
+
+def analyze_file(file_path, file_name, rt_keys, rt_names, plot=True):
+    # Step 1: Load the .txt data into a pd.DataFrame (load_absorbance_data.py)
+    dataframe = load_absorbance_data(file_path / file_name)
+    # Step 2: Perform background correction (bg_corr.py)
+    baseline_corrected_data, baseline = perform_background_correction(dataframe, file_name, file_path, plot)
+    # Step 3: Detect peaks and align with theoretical RTs (find_peaks.py)  
+    return detect_and_highlight_peaks(dataframe['Time (min)'].to_numpy(), baseline_corrected_data, rt_keys, rt_names, file_name, file_path, plot)
 
 def run():
     # Log script run-time 
-    st = time.time()
+    st = time.perf_counter()
 
     file_path = Path('/Users/mateuszfido/Library/CloudStorage/OneDrive-ETHZurich/Mice/UPLC code')
     RT_peaks = {1.433: 'Glu', 
@@ -28,6 +45,12 @@ def run():
                 14.480: 'Leu-Phe',
                 15.433: 'Orn'}
     RT_peaks =  dict(sorted(RT_peaks.items()))  # convert to sorted
+    # Built once and shared by all files
+    rt_keys = np.fromiter(RT_peaks.keys(), dtype=np.float64, count=len(RT_peaks))
+    rt_names = list(RT_peaks.values())
+
+    # Set UPLC_PLOT=0 to skip all plots and only compute the results
+    plot = os.environ.get('UPLC_PLOT', '1') == '1'
 
     cal_files, res_files = read_files(file_path)
 
@@ -37,48 +60,36 @@ def run():
     all_compounds = []
 
     def extract_concentration(filename):
-        match = re.search(r'(\d+(\.\d+)?)mM', filename)
+        match = _CONC_RE.search(filename)
         if match:
             return float(match.group(1))
         else:
             return None
 
-    # Calculate the calibration curves
-    for cal_file in cal_files:
-        print(f'Analyzing {cal_file}...')
-        # Step 1: Load the .txt data into a pd.DataFrame (load_absorbance_data.py)
-        dataframe = load_absorbance_data(file_path / cal_file)
-        # Step 2: Perform background correction (bg_corr.py)
-        baseline_corrected_data, baseline = perform_background_correction(dataframe, cal_file, file_path)
-        # Step 3: Detect peaks and align with theoretical RTs (find_peaks.py)  
-        compounds = detect_and_highlight_peaks(dataframe['Time (min)'], baseline_corrected_data, RT_peaks, cal_file, file_path)
-        # Step 4: Assign the concentration values from the current file to the compounds  
-        concentration = extract_concentration(cal_file)
-        for compound in compounds:
-            compound.concentration = concentration
-        all_compounds.extend(compounds)
-        
-    # Step 5: Graph and return the curve parameters 
-    curve_params = calibrate(all_compounds, file_path)
-    print(curve_params)
-    concentrations = {}
-
-    # Repeat the same process for the measurement files
-    for res_file in res_files:
-        print(f'Analyzing {res_file}...')
-        dataframe = load_absorbance_data(file_path / res_file)
-        baseline_corrected_data, baseline = perform_background_correction(dataframe, res_file, file_path)
-        compounds = detect_and_highlight_peaks(dataframe['Time (min)'], baseline_corrected_data, RT_peaks, res_file, file_path)
-        compounds_in_file = {}
-        for compound in compounds:
-            concentration = calculate_concentration(compound.area, curve_params[compound.name])
-            print(f"Compound {compound.name} in file {res_file} has a concentration of {concentration} mM." )
-            compounds_in_file[compound.name] = [f'{concentration} mM', 
-                                                curve_params[compound.name]['Slope'], 
-                                                curve_params[compound.name]['Intercept'],
-                                                curve_params[compound.name]['R-squared']]
-        concentrations[res_file] = compounds_in_file
-        
+    # Every file is analyzed independently, so all of them are queued on a pool of worker
+    # processes up front (plotting to files only, hence Agg); results come back in order.
+    # Workers are spawned, not forked: forking after numba has started its threading layer
+    # can hang the parent at exit
+    with concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=matplotlib.use, initargs=('Agg',)) as executor:
+        cal_results = executor.map(analyze_file, itertools.repeat(file_path), cal_files, itertools.repeat(rt_keys),
+                                   itertools.repeat(rt_names), itertools.repeat(plot))
+        res_results = executor.map(analyze_file, itertools.repeat(file_path), res_files, itertools.repeat(rt_keys),
+                                   itertools.repeat(rt_names), itertools.repeat(plot))
+
+        # Calculate the calibration curves
+        for cal_file, compounds in zip(cal_files, cal_results):
+            print(f'Analyzing {cal_file}...')
+            # Step 4: Assign the concentration values from the current file to the compounds  
+            compounds.concentration = extract_concentration(cal_file)
+            all_compounds.append(compounds)
+            
+        # Step 5: Graph and return the curve parameters 
+        curve_params = calibrate(all_compounds, file_path, plot)
+        print(curve_params)
+
+        # Repeat the same process for the measurement files, writing each file's block of
+        # results.csv as soon as it is analyzed
         with open(file_path / 'results.csv', 'w', newline='') as csv_file:
             writer = csv.writer(csv_file)
 
@@ -86,18 +97,29 @@ def run():
             header_row = ['File']
             writer.writerow(header_row)
 
-            # Write data rows
-            for outer_key, inner_dict in concentrations.items():
-                writer.writerow([outer_key, 'Compound', 'Concentration', 'Slope', 'Intercept', 'R-squared'])
-                for compound_name, compound_values in inner_dict.items():
+            for res_file, compounds in zip(res_files, res_results):
+                print(f'Analyzing {res_file}...')
+                compounds_in_file = {}
+                for name, area in zip(compounds.names, compounds.areas):
+                    concentration = calculate_concentration(area, curve_params[name])
+                    print(f"Compound {name} in file {res_file} has a concentration of {concentration} mM." )
+                    compounds_in_file[name] = [f'{concentration} mM', 
+                                               curve_params[name]['Slope'], 
+                                               curve_params[name]['Intercept'],
+                                               curve_params[name]['R-squared']]
+
+                # Write data rows
+                writer.writerow([res_file, 'Compound', 'Concentration', 'Slope', 'Intercept', 'R-squared'])
+                for compound_name, compound_values in compounds_in_file.items():
                     data_row = ['', compound_name] + compound_values
                     writer.writerow(data_row)
-                
+
                 writer.writerow([])
 
     # Report the run-time
-    et = time.time()
+    et = time.perf_counter()
     elapsed_time = et - st
     print("Execution time: ", round(elapsed_time, 2), " seconds.")
     
-run()
\ No newline at end of file
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,13 @@
+import sys
+from pathlib import Path
+
+import matplotlib
+
+matplotlib.use('Agg')
+
+# The hplc scripts import each other by module name, so both the repository root
+# and the hplc directory go on the path
+ROOT = Path(__file__).resolve().parents[1]
+for path in (ROOT, ROOT / 'hplc'):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
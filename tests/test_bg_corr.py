@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from scipy.signal import find_peaks
+
+from bg_corr import perform_background_correction
+
+
+def _reference_background_correction(dataframe):
+    # The correction as written before the forward LLS kernel was fused: plain
+    # float64 NumPy, smoothing passes reading the previous pass
+    absorbance = dataframe['Value (mAU)'].to_numpy(dtype=np.float64, copy=True)
+    if (absorbance < 0).any():
+        shift = np.median(absorbance[absorbance < 0])
+    else:
+        shift = 0
+    absorbance -= shift
+    absorbance *= np.heaviside(absorbance, 0)
+    tform = np.log(np.log(np.sqrt(absorbance + 1) + 1) + 1)
+    for i in range(1, 21):
+        tform_new = tform.copy()
+        tform_new[i:-i] = np.minimum(tform[i:-i], 0.5 * (tform[2 * i:] + tform[:-2 * i]))
+        tform = tform_new
+    inv_tform = ((np.exp(np.exp(tform) - 1) - 1)**2 - 1)
+    return np.round((absorbance - inv_tform), decimals=9), inv_tform + shift
+
+
+def _chromatogram(noise, offset):
+    rng = np.random.default_rng(3)
+    t = np.arange(0, 20, 0.0077)
+    y = sum(a * np.exp(-(t - m)**2 / (2 * 0.02**2))
+            for a, m in [(20, 1.886), (35, 3.293), (12, 7.493), (60, 14.48)])
+    y = y + offset + rng.normal(0, noise, t.size) if noise else y + offset
+    # four decimals like the detector export, so the flat stretches are exact
+    y = np.round(y, 4)
+    return pd.DataFrame({'Time (min)': t, 'Value (mAU)': y})
+
+
+def _check_against_reference(dataframe, tmp_path):
+    corrected, baseline = perform_background_correction(dataframe, 'x.txt', tmp_path, plot=False)
+    ref_corrected, ref_baseline = _reference_background_correction(dataframe)
+
+    np.testing.assert_allclose(corrected, ref_corrected, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(baseline, ref_baseline, rtol=1e-12, atol=1e-12)
+
+    # the peak windows, and with them the areas, must not move
+    peaks, props = find_peaks(corrected, prominence=1)
+    ref_peaks, ref_props = find_peaks(ref_corrected, prominence=1)
+    np.testing.assert_array_equal(peaks, ref_peaks)
+    np.testing.assert_array_equal(props['left_bases'], ref_props['left_bases'])
+    np.testing.assert_array_equal(props['right_bases'], ref_props['right_bases'])
+
+
+def test_flat_baseline_matches_reference(tmp_path):
+    _check_against_reference(_chromatogram(noise=0, offset=0), tmp_path)
+
+
+def test_noisy_shifted_baseline_matches_reference(tmp_path):
+    _check_against_reference(_chromatogram(noise=0.05, offset=-1), tmp_path)
+
+
+def test_input_frame_is_not_modified(tmp_path):
+    dataframe = _chromatogram(noise=0.05, offset=-1)
+    before = dataframe['Value (mAU)'].to_numpy().copy()
+    perform_background_correction(dataframe, 'x.txt', tmp_path, plot=False)
+    np.testing.assert_array_equal(dataframe['Value (mAU)'].to_numpy(), before)
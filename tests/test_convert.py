@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+from UPLC_CEC import convert_HPLC_Zurich
+
+
+def _write_export(path):
+    # 40 header rows as the parser sees them, with blank lines in between and a
+    # quoted comment spanning three lines, followed by the chromatogram
+    header = ['Injection Information:', '', 'Data File\tsample.txt', '"Comment\tfirst line',
+              'second line', 'third line"\tend', '']
+    header += [f'Field {k}\tvalue {k}' for k in range(36)]
+    header += ['', 'Time (min)\tStep (s)\tValue (mV)']
+    data = ["0.00000\t0\t- 0.512", "0.00667\t0.400\t1'234.5", "0.01333\t0.800\t- 1'001.25",
+            "0.02000\t1.200\t3.75"]
+    path.write_text('\n'.join(header + data) + '\n')
+
+
+def _baseline_convert(path):
+    # conversion as it was before the header rows were skipped at read time
+    raw_data = pd.read_csv(path, sep="\t", names=['time_min', 'step', 'intensity_mV'])
+    raw_data = raw_data.drop(raw_data.index[range(40)])
+    for x in range(len(raw_data)):
+        raw_data.iloc[x, 2] = raw_data.iloc[x, 2].replace("- ", "-")
+    raw_data = raw_data.replace({"'": ""}, regex=True)
+    return raw_data.astype(float)
+
+
+def test_header_rows_are_dropped_as_parsed_rows(tmp_path):
+    folder = tmp_path / 'cal'
+    folder.mkdir()
+    _write_export(folder / 'sample.txt')
+
+    convert_HPLC_Zurich(str(folder), None)
+    converted = pd.read_csv(folder / 'converted' / 'sample.csv')
+    expected = _baseline_convert(folder / 'sample.txt')
+
+    assert list(converted.columns) == ['time_min', 'step', 'intensity_mV']
+    assert len(converted) == len(expected) == 4
+    np.testing.assert_array_equal(converted.iloc[0].to_numpy(), [0.0, 0.0, -0.512])
+    np.testing.assert_allclose(converted.to_numpy(), expected.to_numpy(), rtol=1e-6)
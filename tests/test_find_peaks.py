@@ -0,0 +1,46 @@
+import numpy as np
+
+from find_peaks import match_retention_times
+
+
+def _reference_match(peak_times, keys, max_difference):
+    # The original scan: every RT takes the argmin over the peaks still left and removes it
+    remaining = list(range(len(peak_times)))
+    matches = np.full(len(keys), -1)
+    for k, key in enumerate(keys):
+        if not remaining:
+            break
+        peak_number = np.argmin(np.abs(peak_times[remaining] - key))
+        if np.abs(peak_times[remaining[peak_number]] - key) <= max_difference:
+            matches[k] = remaining.pop(peak_number)
+    return matches
+
+
+def test_tie_goes_to_the_earlier_peak():
+    peak_times = np.array([1.0, 1.5])
+    np.testing.assert_array_equal(match_retention_times(peak_times, [1.25], 0.3), [0])
+
+
+def test_two_peaks_within_range_of_the_same_key():
+    peak_times = np.array([1.0, 1.5])
+    # both RTs are closest to the first peak; the second RT falls back to the other one
+    np.testing.assert_array_equal(match_retention_times(peak_times, [1.2, 1.25], 0.3), [0, 1])
+    np.testing.assert_array_equal(match_retention_times(peak_times, [1.25, 1.3], 0.3), [0, 1])
+    # a taken peak is not replaced by one outside max_difference
+    np.testing.assert_array_equal(match_retention_times(peak_times, [1.0, 1.1], 0.3), [0, -1])
+
+
+def test_duplicate_peak_times():
+    peak_times = np.array([1.0, 1.0, 2.0])
+    keys = [1.1, 1.05, 1.2]
+    np.testing.assert_array_equal(match_retention_times(peak_times, keys, 0.3), [0, 1, -1])
+
+
+def test_matches_reference_scan():
+    rng = np.random.default_rng(7)
+    for _ in range(2000):
+        # coarse grids make ties and shared nearest peaks common
+        peak_times = np.sort(rng.integers(0, 20, rng.integers(0, 8)) * 0.25)
+        keys = rng.integers(0, 20, rng.integers(0, 8)) * 0.25 + rng.choice([0, 0.125], 1)
+        np.testing.assert_array_equal(match_retention_times(peak_times, keys, 0.3),
+                                      _reference_match(peak_times, keys, 0.3))
@@ -0,0 +1,43 @@
+import importlib.util
+
+import numpy as np
+import pytest
+
+import load_data
+from load_data import load_absorbance_data
+
+ENGINES = ['c'] + (['pyarrow'] if importlib.util.find_spec('pyarrow') else [])
+
+
+def _write_export(path):
+    # metadata with a quoted field spanning two lines above the data section
+    path.write_text('Injection Information:\n'
+                    '"Comment: first line\n'
+                    'second line"\tend\n'
+                    'Sample\tx\n'
+                    'Chromatogram Data:\n'
+                    'Time (min)\tStep (s)\tValue (mAU)\n'
+                    '0.00000\t\t0.1000\n'
+                    '0.00767\t0.46\t0.2500\n'
+                    '0.01533\t0.46\t-0.3000\n'
+                    '0.02300\t0.46\t1.7500\n')
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_quoted_multiline_header_field(tmp_path, monkeypatch, engine):
+    monkeypatch.setattr(load_data, '_CSV_ENGINE', engine)
+    _write_export(tmp_path / 'sample.txt')
+
+    chromatogram = load_absorbance_data(tmp_path / 'sample.txt')
+
+    # every data row after the first, whose step is empty
+    assert list(chromatogram.columns) == ['Time (min)', 'Value (mAU)']
+    assert chromatogram.dtypes.tolist() == [np.float64, np.float64]
+    np.testing.assert_array_equal(chromatogram.to_numpy(),
+                                  [[0.00767, 0.25], [0.01533, -0.3], [0.023, 1.75]])
+
+
+def test_missing_data_section(tmp_path):
+    (tmp_path / 'sample.txt').write_text('Injection Information:\nSample\tx\n')
+    with pytest.raises(ValueError):
+        load_absorbance_data(tmp_path / 'sample.txt')